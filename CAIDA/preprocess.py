@@ -1,39 +1,152 @@
 """
-Dump CAIDA trace to per-packet numpy array
+Dump CAIDA trace to per-packet 5-tuples
+
+The pcap is parsed directly in buffered chunks: only the record headers and the
+fixed-offset IPv4/TCP/UDP fields are decoded. By default packets are streamed
+into the memory-mapped binary trace format (see binary_trace.py); --pickle
+writes the legacy pickled list read by util.load_trace.
 """
 import argparse
-import socket
+import os
 import pickle
+import struct
+import sys
 
-from scapy.all import *
-from scapy.layers.all import IP, TCP, UDP
 from tqdm import tqdm
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from binary_trace import BinaryTraceWriter
+
+PCAP_MAGIC = {
+    b"\xd4\xc3\xb2\xa1": "<", b"\xa1\xb2\xc3\xd4": ">",  # microsecond timestamps
+    b"\x4d\x3c\xb2\xa1": "<", b"\xa1\xb2\x3c\x4d": ">",  # nanosecond timestamps
+}
+
+# Link types and the offset of the IP header in their frames
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = (12, 14, 101, 228)
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_VLAN = (0x8100, 0x88a8)
+IPPROTO_TCP = 6
+IPPROTO_UDP = 17
+
+
+def ip_offset(linktype, frame):
+    """
+    Offset of the IPv4 header in a frame, or None if the frame does not carry IPv4
+    """
+    if linktype in LINKTYPE_RAW:
+        return 0
+    if linktype == LINKTYPE_ETHERNET:
+        offset = 12
+        while len(frame) >= offset + 2:
+            ethertype = (frame[offset] << 8) | frame[offset + 1]
+            if ethertype in ETHERTYPE_VLAN:
+                offset += 4
+                continue
+            return offset + 2 if ethertype == ETHERTYPE_IPV4 else None
+        return None
+    raise ValueError("Unsupported pcap link type: " + str(linktype))
+
+
+def five_tuple(frame, offset):
+    """
+    13-byte 5-tuple (src IP, dst IP, little-endian sport and dport, proto) of a
+    TCP or UDP over IPv4 packet, or None for anything else
+    """
+    if len(frame) < offset + 20 or frame[offset] >> 4 != 4:
+        return None
+    proto = frame[offset + 9]
+    if proto != IPPROTO_TCP and proto != IPPROTO_UDP:
+        return None
+
+    # Non-first fragments carry no transport header
+    if ((frame[offset + 6] & 0x1f) << 8) | frame[offset + 7]:
+        return None
+
+    l4 = offset + (frame[offset] & 0x0f) * 4
+    if len(frame) < l4 + 4:
+        return None
+    return frame[offset + 12:offset + 20] + \
+        frame[l4:l4 + 2][::-1] + frame[l4 + 2:l4 + 4][::-1] + \
+        bytes((proto,))
+
+
+def iter_five_tuple_batches(input_pcap, batch_size=1 << 16, chunk_size=1 << 22):
+    """
+    Yield lists of up to batch_size 5-tuples, reading the pcap in chunk_size blocks
+    """
+    with open(input_pcap, "rb") as f:
+        global_header = f.read(24)
+        if len(global_header) < 24 or global_header[:4] not in PCAP_MAGIC:
+            raise ValueError("Not a pcap file (pcapng is not supported): " + input_pcap)
+        endian = PCAP_MAGIC[global_header[:4]]
+        linktype = struct.unpack(endian + "I", global_header[20:24])[0] & 0x0fffffff
+        record_header = struct.Struct(endian + "IIII")
+
+        batch = []
+        buf = b""
+        pos = 0
+        progress = tqdm(unit="pkt")
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            buf = buf[pos:] + chunk
+            pos = 0
+            while pos + 16 <= len(buf):
+                incl_len = record_header.unpack_from(buf, pos)[2]
+                if pos + 16 + incl_len > len(buf):
+                    break
+                frame = buf[pos + 16:pos + 16 + incl_len]
+                pos += 16 + incl_len
+
+                offset = ip_offset(linktype, frame)
+                if offset is None:
+                    continue
+                fiveTuple = five_tuple(frame, offset)
+                if fiveTuple is None:
+                    continue
+                batch.append(fiveTuple)
+                if len(batch) >= batch_size:
+                    progress.update(len(batch))
+                    yield batch
+                    batch = []
+        if batch:
+            progress.update(len(batch))
+            yield batch
+        progress.close()
+
+
 def load_trace(input_pcap):
     fiveTuple_list = []
-    for pkt in tqdm(PcapReader(input_pcap)):
-        if IP in pkt and (TCP in pkt or UDP in pkt):
-            sIP = pkt[IP].src
-            dIP = pkt[IP].dst
-            proto = pkt[IP].proto
-            dport = pkt[TCP].dport if TCP in pkt else pkt[UDP].dport
-            sport = pkt[TCP].sport if TCP in pkt else pkt[UDP].sport
-            fiveTuple = socket.inet_aton(sIP) + socket.inet_aton(dIP) + \
-                        sport.to_bytes(2, byteorder="little") + \
-                        dport.to_bytes(2, byteorder="little") + \
-                        proto.to_bytes(1, byteorder="little")
-            fiveTuple_list.append(fiveTuple)
-        else:
-            continue
+    for batch in iter_five_tuple_batches(input_pcap):
+        fiveTuple_list.extend(batch)
     return fiveTuple_list
 
 
+def dump_binary_trace(input_pcap, output_name):
+    """
+    Stream the 5-tuples of a pcap into a binary trace without keeping the packet list
+    """
+    with BinaryTraceWriter(output_name) as writer:
+        for batch in iter_five_tuple_batches(input_pcap):
+            writer.add_packets(batch)
+    return len(writer.flow_index), writer.n_pkts
+
+
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Dump CAIDA pcap to numpy array")
+    parser = argparse.ArgumentParser(description="Dump CAIDA pcap to per-packet 5-tuples")
     parser.add_argument('input_pcap', type=str, help="input CAIDA pcap file" )
     parser.add_argument('output_name', type=str, help="Output file name for dumped trace and stats")
+    parser.add_argument('--pickle', action='store_true',
+                        help="write the legacy pickled list instead of a binary trace")
     args = parser.parse_args()
 
-    fiveTuple_list = load_trace(input_pcap=args.input_pcap)
-    with open(args.output_name, "wb") as f:
-        pickle.dump(fiveTuple_list, f)
+    if args.pickle:
+        fiveTuple_list = load_trace(input_pcap=args.input_pcap)
+        with open(args.output_name, "wb") as f:
+            pickle.dump(fiveTuple_list, f)
+    else:
+        print(dump_binary_trace(args.input_pcap, args.output_name))
@@ -9,11 +9,15 @@ Example 2 (with sampling):
 The preprocessed trace can be found  in this folder '/data/ACF' on TIMI server
 - /data/ACF/equinix-chicago.dirA.20140619-130900.dat
 
+Binary traces (written by CAIDA/preprocess.py or converted with binary_trace.py) are
+memory-mapped instead of unpickled, whatever their file name.
+
 """
 
 import math
 import argparse
 import threading
+import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 import pathlib
@@ -21,19 +25,92 @@ import json
 
 from util import *
 from supported_adaptations import ACF
+from crc_hash import array_to_keys
+from control_plane import DEFAULT_BATCH_SIZE, RegisterSimulator, UpdateStream
+
+
+def replay_queries_batch(acf, flows, flow_ids, inS, isFP):
+    """
+    Replay query packets against a filter that no longer changes (no adaptation).
+    Membership then only depends on the flow, so every queried flow is checked once
+    with ACF.check_membership_batch. Returns (FP, TN) and marks FP flows in isFP.
+    """
+    queried = np.zeros(len(flows), dtype=bool)
+    queried[flow_ids] = True
+    queriedFlows = np.flatnonzero(queried)
+
+    members = np.zeros(len(flows), dtype=bool)
+    members[queriedFlows] = acf.check_membership_batch(flows[queriedFlows])[0]
+
+    outsideS = ~inS[flow_ids]
+    hits = members[flow_ids] & outsideS
+    isFP[flow_ids[hits]] = True
+    return int(hits.sum()), int((outsideS & ~hits).sum())
+
+
+def make_acf(S_flows, fingerprintLength):
+    """
+    ACF sized for S_flows
+    """
+    b_val = math.ceil((S_flows / 0.8)/11)
+
+    print(b_val)
+
+    # Based on ACF paper, ACF reaches the
+    # 95% load when it is filled with all S_flows
+    return ACF(d=13, b=b_val,
+               c=1, fingerprintLength=fingerprintLength, storage="array",
+               hashCacheSize=1 << 16)
 
 
-def run_thread(tid, fiveTuple_list, ratio, n_flows, adapt, fingerprintLength, ratio2FP, ratio2FP_lock):
+def prefix_snapshots(trace, n_flows, ratio_list, fingerprintLength):
+    """
+    S of every ratio is a prefix of the flows in arrival order, so fill one filter
+    and clone it as soon as S of each ratio is inserted. All snapshots share the
+    geometry sized for the largest S (the smallest ratio), so the load of a snapshot
+    drops roughly as 1/(1 + ratio) instead of staying at the load a filter sized
+    per ratio starts from.
+    Returns mappings from ratio to snapshot and from ratio to its load factor.
+    """
+    flows = trace[0]
+    S_sizes = {ratio: min(int(n_flows / (1 + ratio)) + 1, n_flows)
+               for ratio in ratio_list}
+    acf = make_acf(max(S_sizes.values()) - 1, fingerprintLength)
+
+    snapshots = dict()
+    loads = dict()
+    inserted = 0
+    insertionFailures = 0
+    for ratio in sorted(ratio_list, key=lambda ratio: S_sizes[ratio]):
+        for x in array_to_keys(flows[inserted:S_sizes[ratio]]):
+            if not acf.insert(x):
+                insertionFailures += 1
+        inserted = max(inserted, S_sizes[ratio])
+        snapshots[ratio] = acf.clone()
+        loads[ratio] = (inserted - insertionFailures) / (acf.d * acf.b * acf.c)
+        print("ratio={} snapshot at {} flows, {} insertion failures, load {:.3f}".format(
+            ratio, inserted, insertionFailures, loads[ratio]))
+    return snapshots, loads
+
+
+def run_thread(tid, trace, ratio, n_flows, adapt, fingerprintLength, ratio2FP, ratio2FP_lock, acf=None,
+               syncInterval=0, batchSize=DEFAULT_BATCH_SIZE, collectStats=False):
     """
     Calculate false positive rate of ACF
     parameters:
         tid: thread id
-        fiveTuple_list: packet trace
+        trace: interned packet trace, (flows, flow_ids, firstArrival) as returned by load_run_trace
         ratio: A/S ratio
         n_flows: #number of flows in packet trace
         ACF_c: number of cells per bucket in ACF
         ratio2FP: mapping between A/S ratio and FP rate
         ratio2FP_lock: lock associated with mapping
+        acf: filter already holding S of this ratio (see prefix_snapshots), used in place of
+             a fresh fill; it is modified by the query phase
+        syncInterval: with adaptation, stream register updates to a simulated switch
+                      every syncInterval query packets (0 disables the update stream)
+        batchSize: updates per control-plane message
+        collectStats: instrument the filter (ACF.enable_stats) and print its stats at the end
     """
     print("[Thread {}] ratio={} started".format(tid, ratio))
     fp_rate = 0.0
@@ -47,58 +124,83 @@ def run_thread(tid, fiveTuple_list, ratio, n_flows, adapt, fingerprintLength, ra
 
     print(S_flows, A_flows)
 
-    b_val = math.ceil((S_flows / 0.8)/11)
-
-    print(b_val)
-
-    # Based on ACF paper, ACF reaches the
-    # 95% load when it is filled with all S_flows
-    acf = ACF(d=13, b=b_val,
-              c=1, fingerprintLength=fingerprintLength)
-    st = set()
-    fp_set = set()
+    # Flows are numbered in arrival order, so S is the first S_flows + 1 flows
+    # and every packet after the last of them first arrives is a query
+    flows, flow_ids, firstArrival = trace
+    nS = min(S_flows + 1, n_flows)
+    inS = np.zeros(n_flows, dtype=bool)
+    inS[:nS] = True
+    isFP = np.zeros(n_flows, dtype=bool)
+    queries = flow_ids[firstArrival[nS - 1] + 1:]
 
     insertionFailures = 0
 
-    # A_st = set()
-    for fiveTuple in tqdm(fiveTuple_list, desc="[Thread {}]".format(tid)):
-        fiveTuple = int.from_bytes(fiveTuple, byteorder="little")
-        if len(st) <= S_flows:
-            if fiveTuple not in st:
-                if not acf.insert(fiveTuple):
-                    insertionFailures += 1
-                st.add(fiveTuple)
-            # else:
-                # Sanity check, flow should already be in filter
-                # assert acf.check_membership(fiveTuple)
-        else:
-            # The remaining are used to
-            # check false positive rate
-            if acf.check_membership(fiveTuple):
-                if fiveTuple not in st:
-
-                    if fiveTuple not in fp_set:
-                        fp_set.add(fiveTuple)
+    fill = acf is None
+    if fill:
+        acf = make_acf(S_flows, fingerprintLength)
+    if collectStats:
+        acf.enable_stats()
+
+    if fill:
+        for flowId in tqdm(range(nS), desc="[Thread {}] insert".format(tid)):
+            if not acf.insert(flow_key(flows, flowId)):
+                insertionFailures += 1
+
+    # Without adaptation the filter is read-only from here on, so the
+    # queries are replayed in batches
+    if not adapt:
+        FP, TN = replay_queries_batch(acf, flows, queries, inS, isFP)
+
+    else:
+        # Registers are assumed synced with the filled filter, only
+        # the adaptations are streamed
+        updateStream = None
+        if syncInterval > 0:
+            acf.start_delta_tracking()
+            updateStream = UpdateStream(
+                RegisterSimulator.from_acf(acf), batchSize)
+
+        # The remaining are used to
+        # check false positive rate
+        for n, flowId in enumerate(iter_flow_ids(queries, desc="[Thread {}] query".format(tid))):
+            x = flow_key(flows, flowId)
+            if acf.check_membership(x):
+                if not inS[flowId]:
+                    isFP[flowId] = True
 
                     FP += 1
                     # Adapt to FP
                     if adapt == True:
-                        acf.adapt_false_positive(fiveTuple)
-                    # assert acf.check_membership(fiveTuple) == False
+                        acf.adapt_false_positive(x)
+                        if updateStream is not None:
+                            updateStream.push(acf.drain_delta())
+                    # assert acf.check_membership(x) == False
             else:
-                if fiveTuple not in st:
+                if not inS[flowId]:
                     TN += 1
+
+            if updateStream is not None and (n + 1) % syncInterval == 0:
+                updateStream.sync()
+
+        if updateStream is not None:
+            updateStream.sync()
+            assert (updateStream.simulator.registers == acf.register_image()).all()
+            print("[Thread {}] ratio={} control plane {}".format(
+                tid, ratio, updateStream.stats()))
+
     # Calculate FP
     fp_rate = FP / (FP + TN)
-    # print(len(fp_set))
+    # print(int(isFP.sum()))
     # print(FP, TN)
 
     # Add this thread result to the shared mapping across threads
     with ratio2FP_lock:
         ratio2FP[ratio] = fp_rate
     print("[Thread {}] ratio={} finished {} {} {} {}".format(
-        tid, ratio, adapt, FP, TN, len(fp_set)))
-    print(insertionFailures)
+        tid, ratio, adapt, FP, TN, int(isFP.sum())))
+    print(insertionFailures, acf.hash_cache_stats())
+    if collectStats:
+        print("[Thread {}] ratio={} stats {}".format(tid, ratio, acf.stats()))
 
 
 trace_paths = [
@@ -121,50 +223,91 @@ if __name__ == "__main__":
     add_bool_arg(parser, "sample")
     parser.add_argument('-sample_rate', type=float,
                         default=0.1, help="the sample rate")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="run every (ratio, ACF/CF) cell in a pool of this many processes, 0 uses one thread per ratio")
+    parser.add_argument('--prefix-fill', dest='prefix_fill', action='store_true',
+                        help="fill one filter, sized for the smallest ratio, and start every ratio from a snapshot of it. "
+                        "Snapshots are not sized per ratio, their load drops roughly as 1/(1+ratio) "
+                        "(at ratio 100 about 1/50 of the load of a filter sized per ratio), so results are not comparable to res_*; "
+                        "they go to prefix_res_* with the load of every snapshot")
+    parser.add_argument('--sync-interval', dest='sync_interval', type=int, default=0,
+                        help="stream ACF register updates to a simulated switch every this many query packets and report the control-plane rates, 0 disables it")
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help="register updates per control-plane message")
+    parser.add_argument('--stats', action='store_true',
+                        help="instrument every filter and print its hot-path counters and latency histograms")
     args = parser.parse_args()
 
+    resultPrefix = "prefix_" if args.prefix_fill else ""
+    runKwargs = {"syncInterval": args.sync_interval,
+                 "batchSize": args.batch_size,
+                 "collectStats": args.stats}
+
     for (traceLabel, tracePath) in trace_paths:
 
-        # Load trace (generated by CAIDA/preprocess.py)
-        fiveTuple_list = load_trace(
+        # Load trace (generated by CAIDA/preprocess.py, or converted
+        # to the binary format by binary_trace.py) and its stats
+        trace, n_flows, n_pkts = load_run_trace(
             tracePath, args.sample, args.sample_rate)
 
-        # Get stats of this trace
-        n_flows, n_pkts = get_trace_stats(fiveTuple_list)
-
         print(n_flows, n_pkts)
 
         """
         ratio2FP_lock = threading.Lock()
         ratio2FP = dict()
-        run_thread(1, fiveTuple_list, 1, n_flows,
+        run_thread(1, trace, 1, n_flows,
                    True, 0xff, ratio2FP, ratio2FP_lock)
 
         print(ratio2FP)
 
         """
 
-        for fingerprintLength in fingerprint_lengths:
+        # A/S ratio (Michael's sec4.2 experiment)
+        ratio_list = [i for i in range(
+            1, 6)] + [i * 10 for i in range(1, 11)]
+        C_list = [True, False]
+
+        snapshots = dict()
+        snapshotLoads = dict()
+        if args.prefix_fill:
+            for fingerprintLength in fingerprint_lengths:
+                snapshots[fingerprintLength], snapshotLoads[fingerprintLength] = prefix_snapshots(
+                    trace, n_flows, ratio_list, fingerprintLength)
+
+        if args.workers > 0:
+            cells = [(traceLabel, fingerprintLength, ratio, adapt_b)
+                     for fingerprintLength in fingerprint_lengths
+                     for adapt_b in C_list
+                     for ratio in ratio_list]
+            cellKwargs = {cell: dict(runKwargs, acf=snapshots[cell[1]][cell[2]])
+                          if args.prefix_fill else runKwargs
+                          for cell in cells}
+            cellResults = run_cells_in_pool(
+                run_thread, cells, trace, n_flows, args.workers, cellKwargs)
 
-            # A/S ratio (Michael's sec4.2 experiment)
-            ratio_list = [i for i in range(
-                1, 6)] + [i * 10 for i in range(1, 11)]
+        for fingerprintLength in fingerprint_lengths:
 
             fig, ax = plt.subplots()
-            C_list = [True, False]
             label_list = ["ACF", "CF"]
             marker_style_list = ["o", "v"]
             for marker_style, adapt_b, label_style in zip(marker_style_list, C_list, label_list):
                 ratio2FP_lock = threading.Lock()
                 ratio2FP = dict()
-                # Parallel between different ratio
-                thread_list = [threading.Thread(target=run_thread,
-                                                args=(tid, fiveTuple_list, ratio, n_flows, adapt_b, fingerprintLength, ratio2FP, ratio2FP_lock))
-                               for tid, ratio in enumerate(ratio_list)]
-                for thread in thread_list:
-                    thread.start()
-                for thread in thread_list:
-                    thread.join()
+                if args.workers > 0:
+                    for ratio in ratio_list:
+                        ratio2FP[ratio] = cellResults[(
+                            traceLabel, fingerprintLength, ratio, adapt_b)]
+                else:
+                    # Parallel between different ratio
+                    thread_list = [threading.Thread(target=run_thread,
+                                                    args=(tid, trace, ratio, n_flows, adapt_b, fingerprintLength, ratio2FP, ratio2FP_lock),
+                                                    kwargs=dict(runKwargs, acf=snapshots[fingerprintLength][ratio].clone())
+                                                    if args.prefix_fill else runKwargs)
+                                   for tid, ratio in enumerate(ratio_list)]
+                    for thread in thread_list:
+                        thread.start()
+                    for thread in thread_list:
+                        thread.join()
 
                 fp_list = []
                 for ratio in ratio_list:
@@ -173,12 +316,18 @@ if __name__ == "__main__":
                         fillstyle="none", label=label_style)
 
                 print(ratio_list, fp_list)
-                pathlib.Path("data/res_{}_{}_{}.txt".format(fingerprintLength,
-                             traceLabel, label_style)).write_text(json.dumps((ratio_list, fp_list)))
+                result = (ratio_list, fp_list)
+                if args.prefix_fill:
+                    # Snapshot loads, they shrink with the ratio (see prefix_snapshots)
+                    result += ([snapshotLoads[fingerprintLength][ratio]
+                                for ratio in ratio_list],)
+                pathlib.Path("data/{}res_{}_{}_{}.txt".format(resultPrefix, fingerprintLength,
+                             traceLabel, label_style)).write_text(json.dumps(result))
 
             ax.set_xlabel("A/S ratio")
             ax.set_ylabel("False positive rate")
             ax.set_yscale('log')
             ax.set_ylim((10**(-3), 10**(-1)))
             ax.legend()
-            fig.savefig("res_{}_{}.png".format(fingerprintLength, traceLabel))
+            fig.savefig("{}res_{}_{}.png".format(
+                resultPrefix, fingerprintLength, traceLabel))
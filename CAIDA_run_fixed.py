@@ -9,11 +9,15 @@ Example 2 (with sampling):
 The preprocessed trace can be found  in this folder '/data/ACF' on TIMI server
 - /data/ACF/equinix-chicago.dirA.20140619-130900.dat
 
+Binary traces (written by CAIDA/preprocess.py or converted with binary_trace.py) are
+memory-mapped instead of unpickled, whatever their file name.
+
 """
 
 import math
 import argparse
 import threading
+import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 import pathlib
@@ -28,17 +32,50 @@ ratio_list = [i for i in range(1, 6)] + [i * 10 for i in range(1, 11)]
 #ratio_list = [1]
 
 
-def run_thread(tid, fiveTuple_list, ratio, n_flows, adapt, fingerprintLength, ratio2FP, ratio2FP_lock):
+def fill_acf(trace, n_flows, fingerprintLength):
+    """
+    Build the ACF holding S. S does not depend on the ratio, so every
+    (ratio, ACF/CF) run can start from a clone of this filter.
+    """
+    # First, let's calculate the number of flows for set S
+    S_flows = int(n_flows / (1 + max(ratio_list)))
+
+    b_val = math.ceil((S_flows / 0.8)/11)
+
+    print(b_val)
+
+    # Based on ACF paper, ACF reaches the
+    # 95% load when it is filled with all S_flows
+    acf = ACF(d=13, b=b_val,
+              c=1, fingerprintLength=fingerprintLength)
+
+    # S is the first S_flows + 1 flows in arrival order
+    flows = trace[0]
+    nS = min(S_flows + 1, n_flows)
+
+    insertionFailures = 0
+
+    for flowId in tqdm(range(nS), desc="insert"):
+        if not acf.insert(flow_key(flows, flowId)):
+            insertionFailures += 1
+
+    print(insertionFailures)
+
+    return acf
+
+
+def run_thread(tid, trace, ratio, n_flows, adapt, fingerprintLength, ratio2FP, ratio2FP_lock, acf=None):
     """
     Calculate false positive rate of ACF
     parameters:
         tid: thread id
-        fiveTuple_list: packet trace
+        trace: interned packet trace, (flows, flow_ids, firstArrival) as returned by load_run_trace
         ratio: A/S ratio
         n_flows: #number of flows in packet trace
         ACF_c: number of cells per bucket in ACF
         ratio2FP: mapping between A/S ratio and FP rate
         ratio2FP_lock: lock associated with mapping
+        acf: clone of the filter returned by fill_acf, filled here when not given
     """
     print("[Thread {}] ratio={} started".format(tid, ratio))
     fp_rate = 0.0
@@ -52,60 +89,40 @@ def run_thread(tid, fiveTuple_list, ratio, n_flows, adapt, fingerprintLength, ra
 
     print(S_flows, A_flows)
 
-    b_val = math.ceil((S_flows / 0.8)/11)
-
-    print(b_val)
-
-    # Based on ACF paper, ACF reaches the
-    # 95% load when it is filled with all S_flows
-    acf = ACF(d=13, b=b_val,
-              c=1, fingerprintLength=fingerprintLength)
-    st = set()
-    at = set()
-    fp_set = set()
-
-    insertionFailures = 0
-
-    for fiveTuple in tqdm(fiveTuple_list, desc="[Thread {}]".format(tid)):
-        fiveTuple = int.from_bytes(fiveTuple, byteorder="little")
-        if len(st) <= S_flows:
-            if fiveTuple not in st:
-                if not acf.insert(fiveTuple):
-                    insertionFailures += 1
-                st.add(fiveTuple)
-            # else:
-                # Sanity check, flow should already be in filter
-                # assert acf.check_membership(fiveTuple)
-
-        if len(at) <= A_flows:
-            if fiveTuple not in st:
-                at.add(fiveTuple)
-
-        if fiveTuple in st or fiveTuple in at:
-            if acf.check_membership(fiveTuple):
-                if fiveTuple not in st:
-                    if fiveTuple not in fp_set:
-                        fp_set.add(fiveTuple)
-
-                    FP += 1
-                    # Adapt to FP
-                    if adapt == True:
-                        acf.adapt_false_positive(fiveTuple)
-                    #assert acf.check_membership(fiveTuple) == False
-            else:
-                if fiveTuple not in st:
-                    TN += 1
+    if acf is None:
+        acf = fill_acf(trace, n_flows, fingerprintLength)
+
+    # Flows are numbered in arrival order: S is the first S_flows + 1 flows and
+    # A the next A_flows + 1. Every A packet arrives after S is complete, and
+    # queries for S flows never change FP/TN, so only A's packets are replayed.
+    flows, flow_ids, firstArrival = trace
+    nS = min(S_flows + 1, n_flows)
+    nA = min(A_flows + 1, n_flows - nS)
+    isFP = np.zeros(n_flows, dtype=bool)
+    queries = flow_ids[(flow_ids >= nS) & (flow_ids < nS + nA)]
+
+    for flowId in iter_flow_ids(queries, desc="[Thread {}] query".format(tid)):
+        x = flow_key(flows, flowId)
+        if acf.check_membership(x):
+            isFP[flowId] = True
+
+            FP += 1
+            # Adapt to FP
+            if adapt == True:
+                acf.adapt_false_positive(x)
+            #assert acf.check_membership(x) == False
+        else:
+            TN += 1
     # Calculate FP
     fp_rate = FP / (FP + TN)
-    # print(len(fp_set))
+    # print(int(isFP.sum()))
     #print(FP, TN)
 
     # Add this thread result to the shared mapping across threads
     with ratio2FP_lock:
         ratio2FP[ratio] = FP
     print("[Thread {}] ratio={} finished {} {} {} {}".format(
-        tid, ratio, adapt, FP, TN, len(fp_set)))
-    print(insertionFailures)
+        tid, ratio, adapt, FP, TN, int(isFP.sum())))
 
 
 trace_paths = [
@@ -128,45 +145,67 @@ if __name__ == "__main__":
     add_bool_arg(parser, "sample")
     parser.add_argument('-sample_rate', type=float,
                         default=0.1, help="the sample rate")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="run every (ratio, ACF/CF) cell in a pool of this many processes, 0 uses one thread per ratio")
     args = parser.parse_args()
 
     for (traceLabel, tracePath) in trace_paths:
 
-        # Load trace (generated by CAIDA/preprocess.py)
-        fiveTuple_list = load_trace(
+        # Load trace (generated by CAIDA/preprocess.py, or converted
+        # to the binary format by binary_trace.py) and its stats
+        trace, n_flows, n_pkts = load_run_trace(
             tracePath, args.sample, args.sample_rate)
 
-        # Get stats of this trace
-        n_flows, n_pkts = get_trace_stats(fiveTuple_list)
-
         print(n_flows, n_pkts)
 
         """
         ratio2FP_lock = threading.Lock()
         ratio2FP = dict()
-        run_thread(1, fiveTuple_list, 30, n_flows, True, 0xff, ratio2FP, ratio2FP_lock)
+        run_thread(1, trace, 30, n_flows, True, 0xff, ratio2FP, ratio2FP_lock)
 
         print(ratio2FP)
 
         """
 
+        C_list = [True, False]
+
+        # Fill once per fingerprint length, every run gets its own clone
+        filledACF = dict()
+        for fingerprintLength in fingerprint_lengths:
+            filledACF[fingerprintLength] = fill_acf(
+                trace, n_flows, fingerprintLength)
+
+        if args.workers > 0:
+            cells = [(traceLabel, fingerprintLength, ratio, adapt_b)
+                     for fingerprintLength in fingerprint_lengths
+                     for adapt_b in C_list
+                     for ratio in ratio_list]
+            cellKwargs = {cell: {"acf": filledACF[cell[1]]} for cell in cells}
+            cellResults = run_cells_in_pool(
+                run_thread, cells, trace, n_flows, args.workers, cellKwargs)
+
         for fingerprintLength in fingerprint_lengths:
 
             fig, ax = plt.subplots()
-            C_list = [True, False]
             label_list = ["ACF", "CF"]
             marker_style_list = ["o", "v"]
             for marker_style, adapt_b, label_style in zip(marker_style_list, C_list, label_list):
                 ratio2FP_lock = threading.Lock()
                 ratio2FP = dict()
-                # Parallel between different ratio
-                thread_list = [threading.Thread(target=run_thread,
-                                                args=(tid, fiveTuple_list, ratio, n_flows, adapt_b, fingerprintLength, ratio2FP, ratio2FP_lock))
-                               for tid, ratio in enumerate(ratio_list)]
-                for thread in thread_list:
-                    thread.start()
-                for thread in thread_list:
-                    thread.join()
+                if args.workers > 0:
+                    for ratio in ratio_list:
+                        ratio2FP[ratio] = cellResults[(
+                            traceLabel, fingerprintLength, ratio, adapt_b)]
+                else:
+                    # Parallel between different ratio
+                    thread_list = [threading.Thread(target=run_thread,
+                                                    args=(tid, trace, ratio, n_flows, adapt_b, fingerprintLength, ratio2FP, ratio2FP_lock),
+                                                    kwargs={"acf": filledACF[fingerprintLength].clone()})
+                                   for tid, ratio in enumerate(ratio_list)]
+                    for thread in thread_list:
+                        thread.start()
+                    for thread in thread_list:
+                        thread.join()
 
                 fp_list = []
                 for ratio in ratio_list:
@@ -1,87 +1,199 @@
 import hashlib
 import random
+import struct
 import numpy as np
+from collections import deque
+
+import instrumentation
 
 random.seed(10)
 
-""" Compute sha256 of input plus offset.
-Assuming sha256 is totally random and uniform, adding
-small offset (i.e. index of table, or index of slot in block)
-should provide a functionally unique hash function
-"""
-def hash_with_offset(x, n):
-    return hashlib.sha256(str(x + n).encode()).hexdigest()
+""" A sha256 digest is 16 big-endian 16 bit words: the first two
+index the two tables, the other 14 are the fingerprints of x for
+slots 0..13 of a bucket """
+DIGEST_WORDS = struct.Struct(">16H")
+MAX_SLOTS = DIGEST_WORDS.size // 2 - 2
+
+""" Compute sha256 of x once. Assuming sha256 is totally random and
+uniform, its words are functionally independent hash functions """
+def key_digest(x):
+    return hashlib.sha256(str(x).encode()).digest()
+
+""" Return ((bucket in table 0, bucket in table 1), fingerprints of
+slots 0..c-1) of x as integers, all from a single digest """
+def key_hashes(x, b, c):
+    words = DIGEST_WORDS.unpack(key_digest(x))
+    return (words[0] % b, words[1] % b), words[2:2 + c]
 
-""" Return hash as integer, representing index into table.
-Uses first 16 bits of hash """
-def block_hash(x, n, b):
-    return int(hash_with_offset(x,n)[0:4], 16) % b
+""" key_hashes of many keys: (N, 2) bucket and (N, c) fingerprint arrays """
+def key_hashes_batch(xs, b, c):
+    digests = b"".join(key_digest(x) for x in xs)
+    words = np.frombuffer(digests, dtype=">u2").reshape(-1, 16).astype(np.int64)
+    return words[:, 0:2] % b, words[:, 2:2 + c]
 
-""" Return 16 bit hex string, representing fingerprint of element """
-def fingerprint_hash(x, n):
-    return hash_with_offset(x, n + 2)[0:4]
+INSERT_POLICIES = ["random_walk", "bfs"]
 
 """ An implimentation of an adjustable cuckoo filter 
-using the cyclical adjustment mechanism using swapping adjustment
+using the cyclical adjustment mechanism using swapping adjustment.
+insertPolicy picks how room is made for a new element (see insert),
+elements that find no room go to an overflow stash of stashSize keys
+that is checked on lookup.
 """
 class ACF:
 
-    def __init__(self, b, c):
+    def __init__(self, b, c, insertPolicy="random_walk", stashSize=4, maxPathNodes=1000):
+        assert c <= MAX_SLOTS, "one digest holds fingerprints for at most {} slots".format(MAX_SLOTS)
+        if insertPolicy not in INSERT_POLICIES:
+            raise ValueError("Unknown insert policy: " + str(insertPolicy))
         self.c = c
         self.b = b
         self.h = 2
         self.tables = np.full((2, self.b, self.c), None, dtype=object).tolist()     # Table tracking fingerprints
         self.backup = np.full((2, self.b, self.c), None, dtype=object).tolist()     # Table tracking true values
+        self.insertPolicy = insertPolicy
+        self.stashSize = stashSize
+        self.stash = []                                                             # True values that did not fit
+        self.maxPathNodes = maxPathNodes
+        self.lastPathNodes = 0                                                      # BFS nodes of the last path search
+        self.lastRelocations = 0                                                    # Elements moved by the last insert
+        self.instrumentation = None                                                 # Set by enable_stats, see instrumentation.py
+
+    """ key_hashes of x for this filter's geometry, one sha256 digest """
+    def compute_key_hashes(self, x):
+        return key_hashes(x, self.b, self.c)
 
     """ Insert x into the ACF 
-    Returns False if element was successfully inserted and no element was kicked out.
-    Returns x, representing element that was kicked out if max-depth was achieved and no
-    free slot was found (e.g. the table is very full).
+    Returns False if x was inserted (in the tables or the stash) and no element was kicked out.
+    Returns the element that was rejected if no room was found and the stash is full:
+    with the random walk this is whichever element was kicked out last, with BFS it is
+    always x, so no previously inserted element is dropped.
+    """
+    def insert(self, x):
+        if self.insertPolicy == "bfs":
+            path = self.find_insertion_path(x)
+            if path is not False:
+                for (y, (j, h, i)) in path:
+                    self.tables[j][h][i] = self.compute_key_hashes(y)[1][i]
+                    self.backup[j][h][i] = y
+                self.lastRelocations = len(path) - 1
+                return False
+            self.lastRelocations = 0
+            rejected = x
+        else:
+            rejected = self.random_walk_insert(x)
+            if rejected is False:
+                return False
+
+        if len(self.stash) < self.stashSize:
+            self.stash.append(rejected)
+            return False
+        return rejected
+
+    """ Random walk insertion: place x in a free slot of either bucket, or kick out
+    a random element of one of them and place that one, up to 10 times.
+    Returns False, or the element left over after the last kick.
     """
-    def insert(self, x, depth = 0):
+    def random_walk_insert(self, x, depth = 0):
 
+        # depth elements have been kicked out so far
+        self.lastRelocations = depth
         if depth > 10:
             return x
 
+        (buckets, fingerprints) = self.compute_key_hashes(x)
         for j in range(0,2):
-            h = block_hash(x, j, self.b)
+            h = buckets[j]
             for i in range(0, self.c):
                 if self.tables[j][h][i] != None:
                     continue
-                self.tables[j][h][i] = fingerprint_hash(x, i)
+                self.tables[j][h][i] = fingerprints[i]
                 self.backup[j][h][i] = x
                 return False
         
         # Pick random element in block to cuckoo
         h = random.randint(0, 1)
         c = random.randint(0, self.c - 1)
-        h_remove = block_hash(x, h, self.b)
+        h_remove = buckets[h]
 
         # Replace removed element with x
         new_insert = self.backup[h][h_remove][c]
         self.backup[h][h_remove][c] = x
-        self.tables[h][h_remove][c] = fingerprint_hash(x, c)
+        self.tables[h][h_remove][c] = fingerprints[c]
 
         # Cuckoo x
-        return self.insert(new_insert, depth=depth + 1)
+        return self.random_walk_insert(new_insert, depth=depth + 1)
+
+    """ BFS over the elements that could make room for x, each moving to its bucket
+    in the other table, up to maxPathNodes elements. Returns the moves
+    [(element, (table, bucket, slot))] to apply in order, ending with x, or False.
+    The number of expanded elements is recorded in lastPathNodes.
+    """
+    def find_insertion_path(self, x):
+        # Nodes are (element, (table, bucket, slot) it occupies, parent node)
+        nodes = [(x, None, -1)]
+        searchQueue = deque([0])
+        visited = set()
+        expanded = 0
+
+        while searchQueue and expanded < self.maxPathNodes:
+            nodeIndex = searchQueue.popleft()
+            (y, leg, _) = nodes[nodeIndex]
+            expanded += 1
+
+            buckets = self.compute_key_hashes(y)[0]
+            for j in (range(0, 2) if leg is None else [1 - leg[0]]):
+                h = buckets[j]
+                if (j, h) in visited:
+                    continue
+                visited.add((j, h))
+
+                for i in range(0, self.c):
+                    if self.tables[j][h][i] is None:
+                        # Every element on the path moves into the slot its child left
+                        path = [(y, (j, h, i))]
+                        while nodeIndex > 0:
+                            (child, childLeg, nodeIndex) = nodes[nodeIndex]
+                            path.append((nodes[nodeIndex][0], childLeg))
+                        self.lastPathNodes = expanded
+                        return path
+
+                for i in range(0, self.c):
+                    nodes.append((self.backup[j][h][i], (j, h, i), nodeIndex))
+                    searchQueue.append(len(nodes) - 1)
+
+        self.lastPathNodes = expanded
+        return False
 
     """ Search tables for fingerprint and return indices """
     def membership_index(self, x):
+        (buckets, fingerprints) = self.compute_key_hashes(x)
         for i in range(0,2):
-            b = block_hash(x, i, self.b)
+            b = buckets[i]
             for j in range(0, self.c):
-                f = fingerprint_hash(x, j)
-                if self.tables[i][b][j] == f:
+                if self.tables[i][b][j] == fingerprints[j]:
                     return (i, b, j)
         return False
 
-    """ Returns true/false if x in ACF """
+    """ Returns true/false if x in ACF (tables or stash) """
     def check_membership(self, x):
         membership_index = self.membership_index(x)
         if membership_index == False:
-            return False
+            return x in self.stash
         return True
 
+    """ check_membership of many keys at once, as a boolean array.
+    Digests are still computed per key, the rest is vectorized """
+    def check_membership_batch(self, xs):
+        (buckets, fingerprints) = key_hashes_batch(xs, self.b, self.c)
+        table = np.array([[[-1 if f is None else f for f in bucket] for bucket in stage]
+                          for stage in self.tables], dtype=np.int64).reshape(2, self.b, self.c)
+        found = np.zeros(len(buckets), dtype=bool)
+        for i in range(0, 2):
+            found |= (table[i][buckets[:, i]] == fingerprints).any(axis=1)
+        if self.stash:
+            found |= np.array([x in self.stash for x in xs], dtype=bool)
+        return found
+
     """ Swaps collision of false_x with different item in same block """
     def adapt_false_positive(self, false_x):
         (h, b, c) = self.membership_index(false_x)
@@ -101,11 +213,22 @@ class ACF:
         x = self.backup[h][b][c]
         y = self.backup[h][b][swap_index]
 
-        self.tables[h][b][c] = fingerprint_hash(y, c) if y != None else None
-        self.tables[h][b][swap_index] = fingerprint_hash(x, swap_index)
+        self.tables[h][b][c] = self.compute_key_hashes(y)[1][c] if y != None else None
+        self.tables[h][b][swap_index] = self.compute_key_hashes(x)[1][swap_index]
         self.backup[h][b][c] = y
         self.backup[h][b][swap_index] = x
 
+    """ Hot-path counters and latency histograms of this instance, off by default
+    (see instrumentation.py); stats returns None when they are off """
+    def enable_stats(self):
+        instrumentation.enable_stats(self, instrumentation.firewall_wrappers)
+
+    def disable_stats(self):
+        instrumentation.disable_stats(self)
+
+    def stats(self):
+        return instrumentation.stats(self)
+
     def occupancy_stats(self):
         per_table = []
         for i in range(0, self.d):
@@ -120,30 +243,40 @@ class ACF:
 
 
 if __name__ == "__main__":
-    """ Rudimentary test routine for ACF:
+    """ Rudimentary test routine for ACF, run with each insert policy:
     1. Picks a random int, n
     2. If n is true positive, asserts ACF agrees
     3. If n is false positive, calls ACF adjust and asserts false positive is fixed
     4. If n is true negative, inserts n and checks that it was inserted
+    Stops at the first element rejected with a full stash and reports the load
+    reached. With BFS the rejected element is always n, so no stored element is lost.
     """
-    acf = ACF(100,4)
-    insert_list = []
-    while True:   
-        print(len(insert_list)) 
-        n = random.randint(0, 900000000)
-        if n in insert_list:
-            assert acf.check_membership(n)
-        else:
-            if acf.check_membership(n):
-                acf.adapt_false_positive(n)
-                assert not acf.check_membership(n)
+    for policy in INSERT_POLICIES:
+        random.seed(10)
+        acf = ACF(100, 4, insertPolicy=policy)
+        insert_list = []
+        while True:
+            n = random.randint(0, 900000000)
+            if n in insert_list:
+                assert acf.check_membership(n)
             else:
-                res = acf.insert(n)
-                insert_list.append(n)
-                if res:
-                    insert_list.remove(res)
-                # Sometimes (rarely) the element that gets cuckooed out (due to depth limit)
-                # is the element we were trying to insert originally. If this is the case, we
-                # don't expect n to be in the acf
-                if res == n: continue
-                assert acf.check_membership(n)
\ No newline at end of file
+                if acf.check_membership(n):
+                    acf.adapt_false_positive(n)
+                    assert not acf.check_membership(n)
+                else:
+                    res = acf.insert(n)
+                    insert_list.append(n)
+                    if res:
+                        # The random walk can reject an element inserted earlier,
+                        # BFS only ever rejects n itself
+                        insert_list.remove(res)
+                        if policy == "bfs":
+                            assert res == n
+                        break
+                    assert acf.check_membership(n)
+
+        # Every element that was not rejected is still stored
+        assert all(acf.check_membership(x) for x in insert_list)
+        print("{}: first rejection at {} elements, load {:.3f} ({} in the stash)".format(
+            policy, len(insert_list), (len(insert_list) - len(acf.stash)) / (2 * acf.b * acf.c),
+            len(acf.stash)))
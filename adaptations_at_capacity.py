@@ -1,314 +1,187 @@
 import struct
 import math
-import random
-import crcmod
 import numpy as np
 import pathlib
 import json
+import argparse
+import multiprocessing
+import os
+from collections import deque
 
-"""
-Generate a random MAC address.
-"""
+import supported_adaptations
+from key_stream import random_keys
+from crc_hash import array_to_keys
 
 
-def randomSrc():
-    return random.randint(1, 2**104)
-
-
-""" 
-Compute the fingerprint for a given MAC address
-"""
-
-
-"""
-Generate fingerprint from int representing 5-tuple
-"""
-
-
-def crc_from_eth(src, fingerprintLength):
-    hash2_func = crcmod.predefined.mkCrcFun('crc-32-bzip2')
-    # src_hex = int(src[6:17].replace(":", ""), 16)
-    return hash2_func(src.to_bytes(13, "little")) & fingerprintLength
-
-
-class ACF():
-    def __init__(self, d, b, c, fingerprintLength):
-        self.fingerprintLength = fingerprintLength
-        self.c = c
-        self.bexp = b
-        self.b = b
-        self.d = d
-        self.tables = np.full((d, self.b, self.c), None, dtype=object).tolist()
-        self.backup = np.full((d, self.b, self.c), None, dtype=object).tolist()
-
+class ACF(supported_adaptations.ACF):
     """
-    Compute the bucket index for a given fingerprint and table index
+    Capacity sweep variant: a false positive that is no longer in the filter counts as
+    handled, and each adaptation reinserts the colliding item once without re-checking
+    (a successful reinsert is reported as RESOLVED).
     """
 
-    def block_hash(self, x, i):
-        hash2_func = crcmod.predefined.mkCrcFun('crc-32-bzip2')
-        srcByteString = x.to_bytes(13, "little")
-        rotatedByteString = srcByteString[i:] + srcByteString[:i]
-
-        if i == 0:
-            assert srcByteString == rotatedByteString
-            assert hash2_func(x.to_bytes(13, "little")) % self.b == hash2_func(
-                rotatedByteString) % self.b
-
-        """
-        if x == 477101476482349837267165074221 or x == 539758783583190476167677316429:
-            print(x)
-            print(i)
-            print(x.to_bytes(13, "little"), rotatedByteString)
-            print(hash2_func(x.to_bytes(13, "little")), hash2_func(rotatedByteString))
-            print(self.b)
-        """
-
-        return hash2_func(rotatedByteString) % self.b
-
-    """
-    Find an insertion path for x by running BFS. An insertion path represents all the entries that need to 
-    move in order to insert x.
-    Takes x, the item to insert, and badStates, a list of tables that already have false-positives.
-    Returns a list of table indices that represent the path to insert x.
-    """
-
-    def find_insertion_path(self, x, badStates=[][:]):
-        searchQueue = [[[x, badStates], []]]
-        for _ in range(0, 1000):
-            if len(searchQueue) < 1:
-                print("1000 iterations")
-                break
-
-            [[n, nbadStates], path] = searchQueue.pop(0)
-            # fingerprint = crc_from_eth(n, es)
-            for i in range(0, self.d):
-                if i in nbadStates:
-                    continue
+    def adapt_false_positive(self, false_x, maxRetries=None):
 
-                # Calculate new path if we inserted into this table
-                h = self.block_hash(x, i)
-                newPath = path.copy()
-                newPath.append(i)
+        membershipIndex = self.membership_index(false_x)
+        self.lastAdaptRetries = 0
 
-                # If we found a free space, return the path so we can insert
-                if self.tables[i][h][0] is None:
-                    return newPath
+        if membershipIndex == False:
+            return supported_adaptations.AdaptOutcome.NOT_PRESENT
 
-                # Otherwise, push to the queue so we can check the next degree
-                [newX, newBadStates] = self.backup[i][h][0]
-                searchQueue.append([[newX, newBadStates], newPath])
+        # Reinsert to try to find new position
+        self.lastAdaptRetries = 1
+        if not self.relocate_colliding(membershipIndex):
+            return supported_adaptations.AdaptOutcome.REINSERT_FAILED
+        return supported_adaptations.AdaptOutcome.RESOLVED
 
-        # No path found
-        return False
 
+def run_trial(task):
     """
-    Calculate insertion path and execute insertion operations
+    Grow one filter through the occupancy levels (in %) and count the adaptations a
+    clone of it supports at each level before a reinsert fails.
+    Returns a mapping from occupancy to adaptations, levels the fill did not reach
+    are missing.
     """
-
-    def insert(self, x, badStates=[][:]):
-
-        insertionPath = self.find_insertion_path(x, badStates.copy())
-
-        if insertionPath is False:
-            return False
-
-        # Setup initial insertion
-        toInsert = [x, badStates.copy()]
-
-        # print(insertionPath)
-
-        for i in range(0, len(insertionPath)):
-
-            if toInsert is None:
+    occupancies, seedSequence = task
+
+    # Create new filter
+    testCuckoo = ACF(
+        13, 512, 1, 0xff)
+
+    # Insert items until we reach each desired occupancy
+    counts = {int((filterSize*occupancy/100)): occupancy for occupancy in occupancies}
+    keys = iter(array_to_keys(random_keys(max(counts), seedSequence)))
+    result = dict()
+    for (n_insert, checkpoint, src_lst) in supported_adaptations.fill_checkpoints(
+            testCuckoo, counts, keys.__next__):
+        FP = 0
+        while True:
+            x = src_lst[FP % len(src_lst)]
+
+            if not checkpoint.adapt_false_positive(x):
                 break
 
-            # print(toInsert)
-
-            legTable = insertionPath[i]
-            toInsertFingerprint = crc_from_eth(
-                toInsert[0], self.fingerprintLength)
-            h = self.block_hash(toInsert[0], legTable)
-
-            toInsertTmp = None
-            if self.tables[legTable][h][0] is not None:
-                toInsertTmp = self.backup[legTable][h][0].copy()
-
-            self.tables[legTable][h][0] = toInsertFingerprint
-            self.backup[legTable][h][0] = toInsert.copy()
-
-            toInsert = toInsertTmp
-
-        return True
+            # assert checkpoint.check_membership(x) == False
+            FP += 1
 
-    """ Search tables for fingerprint and return indices """
+        result[counts[n_insert]] = FP
 
-    def membership_index(self, x):
-        fingerprint = crc_from_eth(x, self.fingerprintLength)
-        for i in range(0, self.d):
-            b = self.block_hash(x, i)
-            for j in range(0, self.c):
-                if self.tables[i][b][j] == fingerprint:
-                    return (i, b, j)
-        return False
+    return result
 
-    """ Returns true/false if x in ACF """
-
-    def check_membership(self, x):
-        membership_index = self.membership_index(x)
-        if membership_index == False:
-            return False
-        return True
-
-    """ Swaps collision of false_x with different item in same block """
-
-    def adapt_false_positive(self, false_x):
-
-        membershipIndex = self.membership_index(false_x)
-
-        if membershipIndex == False:
-            return True
-            # raise "False positive not in ACF"
-
-        (h, b, c) = membershipIndex
-        [x, xBadStates] = self.backup[h][b][c]
-
-        """
-        print(x, false_x)
-        print(x.to_bytes(13, "little"), false_x.to_bytes(13, "little"))
-        
-        print(crc_from_eth(x), crc_from_eth(false_x))
-        print(crc_from_eth(x + 2), crc_from_eth(false_x + 2))
-
-        print(self.block_hash(x, 0), self.block_hash(false_x, 0))
-        print(self.block_hash(x, 3), self.block_hash(false_x, 3))
-        print(self.b)
-        """
-
-        # Mark current position as bad
-        xBadStates.append(h)
-
-        # Remove from current position
-        self.backup[h][b][c] = None
-        self.tables[h][b][c] = None
-
-        # Reinsert to try to find new position
-        insertSuccess = self.insert(x, xBadStates.copy())
-
-        # Make sure we've resolve the conflict or retry
-        if not insertSuccess:
-            return insertSuccess
-
-        # if self.check_membership(false_x) == True:
-        #    return self.adapt_false_positive(false_x)
-
-        return True
 
+def trial_seed(seed, trial):
     """
-    Print current state of the filter tables.
+    Independent, reproducible stream of one trial. The fill only depends on the stream,
+    so a level gives the same result whatever other levels are measured.
     """
+    return np.random.SeedSequence(seed, spawn_key=(trial,))
 
-    def printState(self):
-        print(self.tables)
-        print(self.backup)
 
+def confidence_half_width(values):
     """
-    Count items in filter. Useful as sanity check.
+    Half width of the normal 95% confidence interval on the mean of values
     """
+    if len(values) < 2:
+        return math.inf
+    return 1.96 * np.std(values, ddof=1) / math.sqrt(len(values))
 
-    def countOccupancy(self):
-        count = 0
-        for i in range(0, self.d):
-            for j in range(0, self.b):
-                for k in range(0, self.c):
-                    if self.tables[i][j][k] is not None:
-                        count += 1
-        print("Occupancy is: " + str(count))
 
+def converged(trials, occupancies, relativeCI):
     """
-    Print the occupancy of each stage in the filter
+    Whether, for every level all trials reached, the 95% confidence interval on the
+    mean number of adaptations is within relativeCI of the mean. A level some trial
+    did not reach is not waited for.
     """
+    for occupancy in occupancies:
+        adaptations = [result[occupancy] for result in trials if occupancy in result]
+        if len(adaptations) < len(trials):
+            continue
+        if confidence_half_width(adaptations) > relativeCI * np.mean(adaptations):
+            return False
+    return True
 
-    def occupancy_stats(self):
-        per_table = []
-        for i in range(0, self.d):
-            total = 0
-            full = 0
-            for j in range(0, self.b):
-                for k in range(0, self.c):
-                    total += 1
-                    if self.tables[i][j][k] is not None:
-                        full += 1
-            per_table.append((total, full))
-        print(per_table)
 
+def monte_carlo(pool, occupancies, seed, minTrials, maxTrials, relativeCI, lookahead):
     """
-    Get delta between CuckooFilter and tofino register state. Used to update tofino registers.
+    Run sweep trials over the occupancy levels until converged (after at least
+    minTrials) or maxTrials ran. Up to lookahead trials run ahead in the pool, but
+    results are taken in trial order and the stopping rule is applied after every
+    trial, so the trials kept only depend on the seed, minTrials, maxTrials and
+    relativeCI, not on the number of workers.
+    Returns the per-trial results of run_trial.
     """
-
-    def getDelta(self, regState):
-        delta = []
-        for i in range(0, self.d):
-            for j in range(0, self.b):
-                tableVal = self.tables[i][j][0]
-                if tableVal is None:
-                    tableVal = 0
-
-                if not tableVal == regState[i][j]:
-                    delta.append((i, j, tableVal // 4))
-        return delta
-
-
-configurations = [(2, 7, 1), (3, 7, 1), (4, 7, 1),
-                  (5, 7, 1), (3, 8, 1), (3, 9, 1), (3, 10, 1)]
+    trials = []
+    pending = deque()
+    nextTrial = 0
+    while len(trials) < maxTrials:
+        while nextTrial < maxTrials and len(pending) < max(1, lookahead):
+            pending.append(pool.apply_async(
+                run_trial, ((occupancies, trial_seed(seed, nextTrial)),)))
+            nextTrial += 1
+        trials.append(pending.popleft().get())
+        if len(trials) >= minTrials and converged(trials, occupancies, relativeCI):
+            break
+
+    # Trials that ran ahead of the stop are dropped, the pool is terminated on exit
+    for occupancy in occupancies:
+        adaptations = [result[occupancy] for result in trials if occupancy in result]
+        if len(adaptations) < len(trials):
+            print(occupancy, "Did not reach capacity")
+            continue
+        print(occupancy, len(adaptations), np.mean(adaptations),
+              confidence_half_width(adaptations))
+    return trials
 
 
 filterSize = 13*512
 iterations = 10
 if __name__ == "__main__":
-
-    for s_count in range(8, 9):
+    parser = argparse.ArgumentParser(
+        description="Count supported adaptations of a filled ACF at each occupancy")
+    parser.add_argument('--levels', nargs="+", type=int, default=[8],
+                        help="occupancy levels to run, level n is n*10 %%")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="worker processes running the trials, results do not depend on it")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="root seed of the trial streams")
+    parser.add_argument('--min-trials', dest='min_trials', type=int, default=5,
+                        help="trials to run before stopping early")
+    parser.add_argument('--max-trials', dest='max_trials', type=int, default=iterations,
+                        help="trials to run at most per occupancy")
+    parser.add_argument('--ci', type=float, default=0.05,
+                        help="stop once the 95%% confidence half width is within this fraction of the mean")
+    args = parser.parse_args()
+
+    occupancies = [s_count*10 for s_count in args.levels]
+    with multiprocessing.Pool(args.workers) as pool:
+        trials = monte_carlo(pool, occupancies, args.seed, args.min_trials,
+                             args.max_trials, args.ci, args.workers)
+
+    for s_count in args.levels:
         occupancy = s_count*10
-        adaptation_result = []
-
-        for _ in range(0, iterations):
-
-            # Create new filter
-            testCuckoo = ACF(
-                13, 512, 1, 0xff)
-
-            # Insert items until we reach the desired occupancy
-            n_insert = int((filterSize*occupancy/100))
-            i_st = set()
-
-            reachedCapacity = True
-            while len(i_st) < n_insert:
-                x = randomSrc()
-                i_st.add(x)
-
-                if not testCuckoo.insert(x):
-                    reachedCapacity = False
-                    print("Did not reach capacity")
-
-            if not reachedCapacity:
-                break
-
-            FP = 0
-            src_lst = list(i_st)
-            while True:
-                x = src_lst[FP % len(src_lst)]
-
-                if not testCuckoo.adapt_false_positive(x):
-                    break
-
-                # assert testCuckoo.check_membership(x) == False
-                FP += 1
+        adaptation_result = [result[occupancy] for result in trials
+                             if occupancy in result]
 
-            print(FP)
-            adaptation_result.append(FP)
+        if len(adaptation_result) == 0:
+            continue
 
         print(s_count*10, sum(adaptation_result) /
               len(adaptation_result), adaptation_result)
 
         pathlib.Path("param_results/capacity{}.json".format(s_count)).write_text(json.dumps((s_count*10, sum(adaptation_result) /
                                                                                              len(adaptation_result), adaptation_result)))
+        halfWidth = confidence_half_width(adaptation_result)
+        # Per-trial distribution next to the summary make_graphs_adaptations.py reads
+        pathlib.Path("param_results/capacity{}_trials.json".format(s_count)).write_text(json.dumps({
+            "occupancy": occupancy,
+            "seed": args.seed,
+            "trials": [{"trial": trial, "adaptations": result.get(occupancy),
+                        "reached_capacity": occupancy in result}
+                       for trial, result in enumerate(trials)],
+            "mean": float(np.mean(adaptation_result)),
+            "std": float(np.std(adaptation_result)),
+            # Undefined below 2 trials, written as null (JSON has no Infinity)
+            "ci95_half_width": halfWidth if math.isfinite(halfWidth) else None,
+            "quantiles": {str(q): float(np.quantile(adaptation_result, q))
+                          for q in (0.05, 0.25, 0.5, 0.75, 0.95)},
+        }))
@@ -0,0 +1,341 @@
+"""
+Micro-benchmarks for the filter implementations
+
+Measures throughput and per-op latency of insert, membership (hits and misses),
+BFS insertion path search and false positive adaptation over a grid of load
+factors, stage counts and fingerprint widths for
+    - supported_adaptations.ACF (BFS cuckoo filter)
+    - acf_firewall.ACF (2 tables, 16-bit fingerprints), with each insert policy
+    - sliding_hash_supported_adaptations.CuckooFilter (1 table, 8-bit sliding fingerprints)
+acf_firewall and the sliding hash filter have a fixed stage count and fingerprint
+width, so they only run the load factor axis of the grid (acf_firewall once per
+--firewall-policies entry; results carry the policy).
+Adaptation is timed on false positives of fresh keys, drawn until --adapt-ops are
+found or --adapt-attempts keys were tried (reported as candidates).
+
+Run the grid and save it as a baseline:
+    python benchmark.py -o benchmark.json
+Run again and flag latency regressions against the baseline (exits with 1 if any):
+    python benchmark.py -o new.json --baseline benchmark.json
+"""
+
+import argparse
+import json
+import math
+import platform
+import random
+import sys
+import time
+
+import numpy as np
+
+import supported_adaptations
+import acf_firewall
+import sliding_hash_supported_adaptations
+from key_stream import random_keys
+from crc_hash import array_to_keys, keys_to_array
+
+IMPLEMENTATIONS = ["supported", "firewall", "sliding"]
+OPS = ["insert", "member_hit", "member_miss", "bfs_path", "adapt"]
+
+FIREWALL_SLOTS = 4
+SLIDING_SLOTS = 8
+
+# Fresh keys drawn at a time when searching for false positives to adapt
+CANDIDATE_BATCH = 1 << 14
+
+
+def supported_target(stages, fingerprintLength, slots, c, storage):
+    """
+    Benchmark hooks for supported_adaptations.ACF
+    """
+    acf = supported_adaptations.ACF(stages, max(1, slots // (stages * c)), c,
+                                    fingerprintLength, storage=storage)
+    return {
+        "capacity": acf.d * acf.b * acf.c,
+        "keys": lambda rng, n: array_to_keys(random_keys(n, rng.getrandbits(64))),
+        "insert": acf.insert,
+        "member": acf.check_membership,
+        "positives": lambda xs: [x for x, hit in zip(xs, acf.check_membership_batch(keys_to_array(xs))[0])
+                                 if hit],
+        "path": lambda x: acf.find_insertion_path(x, []),
+        "adapt": acf.adapt_false_positive,
+    }
+
+
+def firewall_target(slots, policy):
+    """
+    Benchmark hooks for acf_firewall.ACF, whose insert returns False or the element
+    it dropped (with the random walk, not necessarily the one being inserted).
+    The BFS path search is read-only, so it is timed whatever the insert policy.
+    """
+    acf = acf_firewall.ACF(max(1, slots // (2 * FIREWALL_SLOTS)), FIREWALL_SLOTS,
+                           insertPolicy=policy)
+
+    def adapt(x):
+        acf.adapt_false_positive(x)
+        return True
+
+    return {
+        "capacity": 2 * acf.b * acf.c,
+        "keys": lambda rng, n: [rng.randint(1, 2**62) for _ in range(n)],
+        "insert": acf.insert,
+        "evicts": True,
+        "member": acf.check_membership,
+        "positives": lambda xs: [x for x, hit in zip(xs, acf.check_membership_batch(xs)) if hit],
+        "path": acf.find_insertion_path,
+        "adapt": adapt,
+    }
+
+
+def sliding_target(slots):
+    """
+    Benchmark hooks for sliding_hash_supported_adaptations.CuckooFilter (keys are MAC addresses)
+    """
+    bexp = max(0, round(math.log2(max(1, slots // SLIDING_SLOTS))))
+    cf = sliding_hash_supported_adaptations.CuckooFilter(1, bexp, SLIDING_SLOTS)
+    return {
+        "capacity": cf.d * cf.b * cf.c,
+        "keys": lambda rng, n: [":".join("{:02x}".format(rng.randrange(256)) for _ in range(6))
+                                for _ in range(n)],
+        "insert": cf.insert,
+        "member": cf.check_membership,
+        "path": None,
+        "adapt": cf.adapt_false_positive,
+    }
+
+
+def timed(fn, xs):
+    """
+    Call fn on every x, return the results and the latency of each call in ns
+    """
+    results = []
+    latencies = []
+    for x in xs:
+        start = time.perf_counter_ns()
+        results.append(fn(x))
+        latencies.append(time.perf_counter_ns() - start)
+    return results, latencies
+
+
+def summarize(latencies):
+    """
+    Throughput and latency percentiles (microseconds) of a list of ns latencies
+    """
+    if len(latencies) == 0:
+        return {"count": 0, "ops_per_sec": None, "mean_us": None,
+                "p50_us": None, "p99_us": None, "max_us": None}
+    lat = np.array(latencies, dtype=np.float64) / 1000
+    return {
+        "count": len(latencies),
+        "ops_per_sec": len(latencies) / (lat.sum() / 1e6) if lat.sum() > 0 else None,
+        "mean_us": float(lat.mean()),
+        "p50_us": float(np.percentile(lat, 50)),
+        "p99_us": float(np.percentile(lat, 99)),
+        "max_us": float(lat.max()),
+    }
+
+
+def run_cell(target, load, ops, adaptOps, adaptAttempts, seed):
+    """
+    Fill a fresh filter to load and time every operation on it. seed is any
+    random.Random seed, the same seed gives the same keys. The module-global random,
+    which the firewall and sliding hash filters draw from, is reseeded with it too.
+    Up to adaptOps false positives of fresh keys are adapted, drawn until they are
+    found or adaptAttempts keys were tried.
+    Returns a mapping from op to its summary (plus failures).
+    """
+    rng = random.Random(seed)
+    random.seed(seed)
+    keys = target["keys"]
+    results = dict()
+
+    # insert: every insert of the fill from empty up to the load factor
+    fill = keys(rng, int(load * target["capacity"]))
+    inserted, latencies = timed(target["insert"], fill)
+    if target.get("evicts"):
+        # insert returns False or the element it dropped, which may be stored earlier
+        dropped = set(x for x in inserted if x is not False)
+        results["insert"] = dict(summarize(latencies), failures=len(dropped))
+        members = [x for x in fill if x not in dropped]
+    else:
+        results["insert"] = dict(summarize(latencies),
+                                 failures=inserted.count(False))
+        members = [x for x, ok in zip(fill, inserted) if ok]
+
+    # membership of stored keys and of fresh keys
+    hits = rng.sample(members, min(ops, len(members)))
+    found, latencies = timed(target["member"], hits)
+    results["member_hit"] = dict(summarize(latencies),
+                                 failures=found.count(False))
+
+    misses = keys(rng, ops)
+    found, latencies = timed(target["member"], misses)
+    results["member_miss"] = dict(summarize(latencies),
+                                  failures=found.count(True))
+
+    # BFS path search for fresh keys, read-only
+    if target["path"] is not None:
+        paths, latencies = timed(target["path"], misses)
+        results["bfs_path"] = dict(summarize(latencies),
+                                   failures=paths.count(False))
+
+    # Adapt false positives of fresh keys. Candidates are screened a batch at a
+    # time, and an earlier adaptation can change the answer for a later one, so
+    # membership is re-checked right before each adaptation.
+    positives = target.get("positives") or (
+        lambda xs: [x for x in xs if target["member"](x)])
+    latencies = []
+    failures = 0
+    attempts = 0
+    while len(latencies) < adaptOps and attempts < adaptAttempts:
+        candidates = keys(rng, min(CANDIDATE_BATCH, adaptAttempts - attempts))
+        attempts += len(candidates)
+        for x in positives(candidates):
+            if len(latencies) == adaptOps:
+                break
+            if not target["member"](x):
+                continue
+            (adapted,), (latency,) = timed(target["adapt"], [x])
+            latencies.append(latency)
+            if not adapted:
+                failures += 1
+    results["adapt"] = dict(summarize(latencies), failures=failures,
+                            candidates=attempts)
+
+    return results
+
+
+def grid(args):
+    """
+    (impl, policy, stages, fingerprint bits, load, target factory) for every benchmark
+    cell, policy is the acf_firewall insert policy (None for the other filters)
+    """
+    cells = []
+    for load in args.loads:
+        if "supported" in args.impl:
+            for stages in args.stages:
+                for fingerprintLength in args.fingerprints:
+                    cells.append(("supported", None, stages, fingerprintLength.bit_length(), load,
+                                  lambda stages=stages, fingerprintLength=fingerprintLength:
+                                  supported_target(stages, fingerprintLength, args.slots,
+                                                   args.c, args.storage)))
+        if "firewall" in args.impl:
+            for policy in args.firewall_policies:
+                cells.append(("firewall", policy, 2, 16, load,
+                              lambda policy=policy: firewall_target(args.slots, policy)))
+        if "sliding" in args.impl:
+            cells.append(("sliding", None, 1, 8, load,
+                          lambda: sliding_target(args.slots)))
+    return cells
+
+
+def result_key(result):
+    return (result["impl"], result.get("policy"), result["stages"],
+            result["fingerprint_bits"], result["load"], result["op"])
+
+
+def cell_label(impl, policy):
+    return impl if policy is None else "{}/{}".format(impl, policy)
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare with a baseline run. The median latency is compared, it is far less
+    noisy than the mean over a few hundred ops. Returns the cells whose median
+    latency grew by more than threshold.
+    """
+    base = {result_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = base.get(result_key(result))
+        if old is None or not old["p50_us"] or not result["p50_us"]:
+            continue
+        change = result["p50_us"] / old["p50_us"] - 1
+        (impl, policy, *cell) = result_key(result)
+        print("{:<21} d={:<2} f={:<2} load={:<5} {:<12} p50 {:>9.1f} -> {:>9.1f} us {:+.1%}{}".format(
+            cell_label(impl, policy), *cell, old["p50_us"], result["p50_us"], change,
+            "  REGRESSION" if change > threshold else ""))
+        if change > threshold:
+            regressions.append((result_key(result), old["p50_us"],
+                                result["p50_us"], change))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmarks for the filter implementations")
+    parser.add_argument('--impl', nargs="+", choices=IMPLEMENTATIONS, default=IMPLEMENTATIONS,
+                        help="implementations to benchmark")
+    parser.add_argument('--loads', nargs="+", type=float, default=[0.5, 0.8, 0.95],
+                        help="load factors to fill the filters to")
+    parser.add_argument('--firewall-policies', dest='firewall_policies', nargs="+",
+                        choices=acf_firewall.INSERT_POLICIES, default=acf_firewall.INSERT_POLICIES,
+                        help="insert policies of acf_firewall.ACF")
+    parser.add_argument('--stages', nargs="+", type=int, default=[2, 4, 8],
+                        help="stage counts of supported_adaptations.ACF")
+    parser.add_argument('--fingerprints', nargs="+", type=lambda v: int(v, 0),
+                        default=[0xff, 0xfff, 0xffff],
+                        help="fingerprint masks of supported_adaptations.ACF")
+    parser.add_argument('--slots', type=int, default=4096,
+                        help="total slots of every filter")
+    parser.add_argument('-c', type=int, default=1,
+                        help="slots per bucket of supported_adaptations.ACF")
+    parser.add_argument('--storage', choices=["list", "array"], default="list",
+                        help="table storage of supported_adaptations.ACF")
+    parser.add_argument('--ops', type=int, default=2000,
+                        help="membership/path lookups per cell")
+    parser.add_argument('--adapt-ops', dest='adapt_ops', type=int, default=200,
+                        help="false positives to adapt per cell")
+    parser.add_argument('--adapt-attempts', dest='adapt_attempts', type=int, default=2000000,
+                        help="fresh keys to try at most per cell when searching for false positives to adapt")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', default="benchmark.json",
+                        help="JSON file to write the results to")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare with")
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help="relative growth of the median latency reported as a regression")
+    args = parser.parse_args()
+
+    results = []
+    for (impl, policy, stages, bits, load, makeTarget) in grid(args):
+        # Seeded by the cell, so a cell sees the same keys whatever else is run
+        cellResults = run_cell(makeTarget(), load, args.ops, args.adapt_ops, args.adapt_attempts,
+                               "{}-{}-{}-{}-{}".format(args.seed, cell_label(impl, policy),
+                                                       stages, bits, load))
+        for op in OPS:
+            if op not in cellResults:
+                continue
+            result = dict(impl=impl, policy=policy, stages=stages, fingerprint_bits=bits,
+                          load=load, op=op, **cellResults[op])
+            results.append(result)
+            print("{:<21} d={:<2} f={:<2} load={:<5} {:<12} {:>6} ops {:>12} ops/s p50 {} us p99 {} us failures {}".format(
+                cell_label(impl, policy), stages, bits, load, op, result["count"],
+                "-" if result["ops_per_sec"] is None else "{:.0f}".format(result["ops_per_sec"]),
+                "-" if result["p50_us"] is None else "{:.1f}".format(result["p50_us"]),
+                "-" if result["p99_us"] is None else "{:.1f}".format(result["p99_us"]),
+                result["failures"]))
+
+    meta = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "slots": args.slots,
+        "c": args.c,
+        "storage": args.storage,
+        "ops": args.ops,
+        "adapt_ops": args.adapt_ops,
+        "adapt_attempts": args.adapt_attempts,
+        "seed": args.seed,
+    }
+    with open(args.output, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["meta"] != meta:
+            print("Baseline was run with different settings:", baseline["meta"])
+        regressions = compare(results, baseline, args.threshold)
+        print("{} regressions".format(len(regressions)))
+        if regressions:
+            sys.exit(1)
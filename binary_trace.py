@@ -0,0 +1,193 @@
+"""
+Memory-mapped binary trace format
+
+A trace file holds a flow dictionary and the packet stream as flow ids, both
+readable with np.memmap. All fields are little-endian:
+
+    header    32 bytes: magic b"ACFTRACE", version (uint32), reserved (uint32),
+              n_flows (uint64), n_pkts (uint64)
+    flows     n_flows x 13 bytes, the unique 5-tuples in the layout written by
+              CAIDA/preprocess.py, numbered in first-seen order
+    padding   up to a 4-byte boundary
+    flow_ids  n_pkts x uint32, the flow id of every packet in arrival order
+
+Convert a pickled trace (generated by CAIDA/preprocess.py):
+    python binary_trace.py trace.dat trace.acft
+"""
+
+import argparse
+import os
+import pickle
+import random
+import shutil
+import struct
+
+import numpy as np
+
+BINARY_TRACE_SUFFIX = ".acft"
+MAGIC = b"ACFTRACE"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQQ")
+RECORD_BYTES = 13
+
+
+def flow_ids_offset(n_flows):
+    """
+    Byte offset of the flow id stream
+    """
+    end = HEADER.size + n_flows * RECORD_BYTES
+    return (end + 3) // 4 * 4
+
+
+def is_binary_trace(fname):
+    """
+    Whether fname starts with the binary trace magic, whatever its name (a pickled
+    trace starts with the pickle protocol opcode instead)
+    """
+    with open(fname, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def read_header(fname):
+    """
+    Return (n_flows, n_pkts) from the header of a binary trace
+    """
+    with open(fname, "rb") as f:
+        magic, version, _, n_flows, n_pkts = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC:
+        raise ValueError("Not a binary trace: " + str(fname))
+    if version != VERSION:
+        raise ValueError("Unsupported binary trace version: " + str(version))
+    return n_flows, n_pkts
+
+
+def write_binary_trace(fname, flows, flow_ids):
+    """
+    Write an (n_flows, 13) uint8 flow dictionary and its uint32 flow id stream
+    """
+    flows = np.ascontiguousarray(flows, dtype=np.uint8).reshape(-1, RECORD_BYTES)
+    flow_ids = np.ascontiguousarray(flow_ids, dtype="<u4")
+    n_flows = flows.shape[0]
+    with open(fname, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, n_flows, len(flow_ids)))
+        f.write(flows.tobytes())
+        f.write(b"\0" * (flow_ids_offset(n_flows) - HEADER.size - flows.nbytes))
+        f.write(flow_ids.tobytes())
+
+
+class BinaryTraceWriter():
+    """
+    Stream packets into a binary trace. Only the flow dictionary is held in memory;
+    flow ids go to a side file that is appended after the flows on close().
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.flow_index = dict()
+        self.n_pkts = 0
+        self.ids_name = fname + ".ids.tmp"
+        self.ids_file = open(self.ids_name, "wb")
+
+    def add_packets(self, fiveTuples):
+        flow_index = self.flow_index
+        flow_ids = np.fromiter((flow_index.setdefault(fiveTuple, len(flow_index))
+                                for fiveTuple in fiveTuples), dtype="<u4", count=len(fiveTuples))
+        self.ids_file.write(flow_ids.tobytes())
+        self.n_pkts += len(flow_ids)
+
+    def close(self):
+        self.ids_file.close()
+        n_flows = len(self.flow_index)
+        with open(self.fname, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, 0, n_flows, self.n_pkts))
+            f.write(b"".join(self.flow_index))
+            f.write(b"\0" * (flow_ids_offset(n_flows) -
+                    HEADER.size - n_flows * RECORD_BYTES))
+            with open(self.ids_name, "rb") as ids:
+                shutil.copyfileobj(ids, f)
+        os.remove(self.ids_name)
+        return n_flows, self.n_pkts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+        else:
+            self.ids_file.close()
+            os.remove(self.ids_name)
+
+
+def open_binary_trace(fname):
+    """
+    Memory-map a binary trace. Returns read-only (flows, flow_ids) arrays.
+    """
+    n_flows, n_pkts = read_header(fname)
+    flows = np.memmap(fname, dtype=np.uint8, mode="r", offset=HEADER.size,
+                      shape=(n_flows, RECORD_BYTES)) if n_flows else \
+        np.zeros((0, RECORD_BYTES), dtype=np.uint8)
+    flow_ids = np.memmap(fname, dtype="<u4", mode="r", offset=flow_ids_offset(n_flows),
+                         shape=(n_pkts,)) if n_pkts else np.zeros(0, dtype="<u4")
+    return flows, flow_ids
+
+
+def intern_packets(fiveTuple_list):
+    """
+    Number the distinct 5-tuples of a packet list in first-seen order.
+    Returns the (n_flows, 13) uint8 flow dictionary and the uint32 flow id of every packet.
+    """
+    flow_index = dict()
+    flow_ids = np.empty(len(fiveTuple_list), dtype=np.uint32)
+    for pktIdx, fiveTuple in enumerate(fiveTuple_list):
+        flow_ids[pktIdx] = flow_index.setdefault(fiveTuple, len(flow_index))
+    flows = np.frombuffer(b"".join(flow_index), dtype=np.uint8).reshape(-1, RECORD_BYTES)
+    return flows, flow_ids
+
+
+def convert_pickled_trace(input_name, output_name):
+    """
+    Convert a pickled trace from CAIDA/preprocess.py to the binary format
+    """
+    with open(input_name, "rb") as f:
+        fiveTuple_list = pickle.load(f)
+    flows, flow_ids = intern_packets(fiveTuple_list)
+    write_binary_trace(output_name, flows, flow_ids)
+    return flows.shape[0], len(flow_ids)
+
+
+def load_binary_trace(fname, sample, sample_rate):
+    """
+    Binary counterpart of util.load_trace. Returns (flows, flow_ids); with sampling,
+    only the packets of a random sample of flows are kept and flows are renumbered.
+    """
+    flows, flow_ids = open_binary_trace(fname)
+    if not sample:
+        return flows, flow_ids
+
+    n_flows, n_pkts = flows.shape[0], len(flow_ids)
+    sample_sz = int(sample_rate * n_flows)
+    kept = np.sort(np.array(random.sample(range(n_flows), sample_sz), dtype=np.int64))
+
+    # Sorted ids keep first-seen order among the sampled flows
+    remap = np.full(n_flows, -1, dtype=np.int64)
+    remap[kept] = np.arange(sample_sz)
+    pkt_ids = remap[flow_ids]
+    flow_ids_sample = pkt_ids[pkt_ids >= 0].astype(np.uint32)
+
+    print(n_flows, sample_sz, n_pkts, len(flow_ids_sample))
+
+    return np.ascontiguousarray(flows[kept]), flow_ids_sample
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert a pickled CAIDA trace to the memory-mapped binary format")
+    parser.add_argument('input_trace', type=str,
+                        help="pickled trace generated by CAIDA/preprocess.py")
+    parser.add_argument('output_trace', type=str,
+                        help="output binary trace, conventionally *" + BINARY_TRACE_SUFFIX)
+    args = parser.parse_args()
+
+    n_flows, n_pkts = convert_pickled_trace(args.input_trace, args.output_trace)
+    print(n_flows, n_pkts)
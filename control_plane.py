@@ -0,0 +1,147 @@
+"""
+Control-plane update stream for ACF register state
+
+ACF slot changes (drain_delta entries) are pushed into an UpdateStream, which
+coalesces repeated writes to the same register cell until the next sync. A sync
+packs the surviving updates into fixed-size messages and applies them to a
+RegisterSimulator, an in-process stand-in for the switch registers. All fields
+are little-endian:
+
+    header    8 bytes: sequence number (uint32), entries used (uint16), reserved (uint16)
+    entries   batchSize x 9 bytes: stage (uint8), register index (uint32), value (uint32)
+
+Unused entries of the last message of a sync are zero padding.
+"""
+
+import struct
+import time
+
+import numpy as np
+
+MESSAGE_HEADER = struct.Struct("<IHH")
+UPDATE_ENTRY = struct.Struct("<BII")
+DEFAULT_BATCH_SIZE = 32
+
+
+def message_bytes(batchSize):
+    """
+    Size of one update message
+    """
+    return MESSAGE_HEADER.size + batchSize * UPDATE_ENTRY.size
+
+
+def encode_message(seq, updates, batchSize):
+    """
+    Pack at most batchSize (stage, index, value) updates into one message
+    """
+    if len(updates) > batchSize:
+        raise ValueError("{} updates do not fit in a batch of {}".format(
+            len(updates), batchSize))
+    message = bytearray(message_bytes(batchSize))
+    MESSAGE_HEADER.pack_into(message, 0, seq, len(updates), 0)
+    for n, (stage, index, value) in enumerate(updates):
+        UPDATE_ENTRY.pack_into(message, MESSAGE_HEADER.size + n * UPDATE_ENTRY.size,
+                               stage, index, value)
+    return bytes(message)
+
+
+def decode_message(message):
+    """
+    Return (seq, updates) of a message
+    """
+    seq, count, _ = MESSAGE_HEADER.unpack_from(message, 0)
+    updates = [UPDATE_ENTRY.unpack_from(message, MESSAGE_HEADER.size + n * UPDATE_ENTRY.size)
+               for n in range(count)]
+    return seq, updates
+
+
+class RegisterSimulator():
+    """
+    Register arrays of the switch, one per stage, written by update messages
+    """
+
+    def __init__(self, d, registers):
+        self.registers = np.zeros((d, registers), dtype=np.uint32)
+        self.nextSeq = 0
+        self.messagesApplied = 0
+        self.updatesApplied = 0
+
+    @classmethod
+    def from_acf(cls, acf):
+        """
+        Simulator preloaded with the current register image of acf
+        """
+        simulator = cls(acf.d, acf.b * acf.c)
+        simulator.registers[:] = acf.register_image()
+        return simulator
+
+    def apply_message(self, message):
+        seq, updates = decode_message(message)
+        if seq != self.nextSeq:
+            raise ValueError("Out of order update message: expected {}, got {}".format(
+                self.nextSeq, seq))
+        for (stage, index, value) in updates:
+            self.registers[stage, index] = value
+        self.nextSeq += 1
+        self.messagesApplied += 1
+        self.updatesApplied += len(updates)
+
+
+class UpdateStream():
+    """
+    Coalescing, batching update pipeline from an ACF to a RegisterSimulator
+    """
+
+    def __init__(self, simulator, batchSize=DEFAULT_BATCH_SIZE):
+        self.simulator = simulator
+        self.batchSize = batchSize
+        self.pending = dict()
+        self.seq = 0
+
+        self.writes = 0
+        self.updates = 0
+        self.messages = 0
+        self.bytes = 0
+        self.syncs = 0
+        self.start = time.perf_counter()
+
+    def push(self, delta):
+        """
+        Queue (stage, index, value) updates, a later write to a cell replaces the pending one
+        """
+        for (stage, index, value) in delta:
+            self.pending[(stage, index)] = value
+        self.writes += len(delta)
+
+    def sync(self):
+        """
+        Send every pending update in fixed-size messages and apply them to the simulator
+        """
+        updates = [(stage, index, value)
+                   for (stage, index), value in sorted(self.pending.items())]
+        self.pending = dict()
+        for n in range(0, len(updates), self.batchSize):
+            message = encode_message(self.seq, updates[n:n + self.batchSize], self.batchSize)
+            self.simulator.apply_message(message)
+            self.seq += 1
+            self.messages += 1
+            self.bytes += len(message)
+        self.updates += len(updates)
+        self.syncs += 1
+
+    def stats(self):
+        """
+        Counters and control-channel rates since the stream was created
+        """
+        elapsed = time.perf_counter() - self.start
+        return {
+            "writes": self.writes,
+            "updates": self.updates,
+            "coalesced": self.writes - self.updates - len(self.pending),
+            "messages": self.messages,
+            "bytes": self.bytes,
+            "syncs": self.syncs,
+            "seconds": elapsed,
+            "updates_per_sec": self.updates / elapsed if elapsed > 0 else 0.0,
+            "bytes_per_sec": self.bytes / elapsed if elapsed > 0 else 0.0,
+        }
@@ -0,0 +1,97 @@
+"""
+CRC-32/bzip2 hashing shared by the filters and experiment scripts
+
+The crcmod function and the lookup table are built once at import time.
+Keys are 13-byte 5-tuples, either as ints (little-endian bytes) or as rows
+of an (N, 13) uint8 matrix.
+"""
+
+import crcmod
+import numpy as np
+
+KEY_BYTES = 13
+
+crc32_bzip2 = crcmod.predefined.mkCrcFun('crc-32-bzip2')
+
+
+def make_crc32_bzip2_table():
+    """
+    Lookup table for the MSB-first CRC-32/bzip2 polynomial
+    """
+    table = np.zeros(256, dtype=np.uint32)
+    for n in range(256):
+        crc = n << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else (crc << 1)
+        table[n] = crc & 0xFFFFFFFF
+    return table
+
+
+CRC32_BZIP2_TABLE = make_crc32_bzip2_table()
+
+
+def rotate_key(srcByteString, i):
+    """
+    Rotate the key bytes left by i, as block_hash does for stage i.
+    Rotations past the key width leave it unchanged.
+    """
+    return srcByteString[i:] + srcByteString[:i]
+
+
+def crc_rotated(x, i):
+    """
+    CRC-32/bzip2 of int key x rotated by i bytes
+    """
+    return crc32_bzip2(rotate_key(x.to_bytes(KEY_BYTES, "little"), i))
+
+
+def crc_all_rotations(x, d):
+    """
+    CRC-32/bzip2 of int key x for each of the first d rotations
+    """
+    srcByteString = x.to_bytes(KEY_BYTES, "little")
+    return [crc32_bzip2(rotate_key(srcByteString, i)) for i in range(d)]
+
+
+def crc32_bzip2_rows(rows):
+    """
+    CRC-32/bzip2 of every row of an (N, L) uint8 matrix, one column at a time
+    """
+    crc = np.full(rows.shape[0], 0xFFFFFFFF, dtype=np.uint32)
+    for col in range(rows.shape[1]):
+        idx = (crc >> np.uint32(24)) ^ rows[:, col]
+        crc = (crc << np.uint32(8)) ^ CRC32_BZIP2_TABLE[idx]
+    return crc ^ np.uint32(0xFFFFFFFF)
+
+
+def rotated_crc32_bzip2(keys, d):
+    """
+    Vectorized crc_all_rotations over an (N, 13) uint8 key matrix.
+    Returns the (d, N) CRCs; row i matches crc_rotated(x, i) for every key.
+    """
+    keys = np.ascontiguousarray(keys, dtype=np.uint8)
+    width = keys.shape[1]
+    rotations = [(np.arange(width) + i) % width if i < width else np.arange(width)
+                 for i in range(d)]
+    # All rotations side by side, hashed in one pass over the columns
+    rotated = keys[:, np.concatenate(rotations)].reshape(-1, d, width)
+    crcs = crc32_bzip2_rows(rotated.transpose(1, 0, 2).reshape(-1, width))
+    return crcs.reshape(d, keys.shape[0])
+
+
+def keys_to_array(xs):
+    """
+    Pack int keys into an (N, 13) uint8 matrix of their little-endian bytes
+    """
+    packed = b"".join(x.to_bytes(KEY_BYTES, "little") for x in xs)
+    return np.frombuffer(packed, dtype=np.uint8).reshape(-1, KEY_BYTES)
+
+
+def array_to_keys(keys):
+    """
+    Inverse of keys_to_array
+    """
+    keys = np.ascontiguousarray(keys, dtype=np.uint8)
+    packed = keys.tobytes()
+    return [int.from_bytes(packed[i:i + KEY_BYTES], "little")
+            for i in range(0, len(packed), KEY_BYTES)]
@@ -0,0 +1,252 @@
+"""
+Optional hot-path instrumentation for the ACF classes
+
+enable_stats(acf) shadows the hot methods of one filter instance with counting,
+timing wrappers; the class and every other instance are untouched, so a filter
+without stats runs exactly the uninstrumented code. The wrappers of
+supported_adaptations.ACF come from supported_wrappers, those of acf_firewall.ACF
+from firewall_wrappers. stats(acf) returns a snapshot of
+
+    hash_computations   supported_adaptations: CRCs computed, d per full key hash
+                        vector (cache misses), 1 per block_hash and per uncached
+                        fingerprint. acf_firewall: sha256 digests computed
+    bfs_nodes           BFS nodes expanded by find_insertion_path
+    path_length         histogram of insertion path lengths (slots written)
+    relocations         histogram of items moved per successful insert (for the
+                        acf_firewall random walk, the items kicked out)
+    adapt_depth         histogram of reinsert attempts per adapt_false_positive
+    adapt_outcomes      count of every AdaptOutcome returned
+    insert_failures     inserts without an insertion path (reinserts included);
+                        acf_firewall: inserts that returned a rejected element
+    adapt_failures      adaptations that returned a falsy outcome
+    stashed             acf_firewall: inserts that went to the overflow stash
+    latency             per-operation log2 histograms, bucket n counts calls that
+                        took [2**n, 2**(n+1)) ns; nested calls (the reinserts of an
+                        adaptation) are only timed outermost
+acf_firewall.adapt_false_positive returns nothing, so adapt_depth, adapt_outcomes
+and adapt_failures stay empty for it.
+"""
+
+import functools
+import time
+from collections import Counter
+
+TIMED_OPS = ["insert", "check_membership",
+             "find_insertion_path", "adapt_false_positive"]
+
+
+class Stats():
+    def __init__(self):
+        self.hashComputations = 0
+        self.bfsNodes = 0
+        self.pathLength = Counter()
+        self.relocations = Counter()
+        self.adaptDepth = Counter()
+        self.adaptOutcomes = Counter()
+        self.insertFailures = 0
+        self.adaptFailures = 0
+        self.stashed = 0
+        self.latency = {op: Counter() for op in TIMED_OPS}
+        self.latencyTotal = {op: 0 for op in TIMED_OPS}
+        self.depth = {op: 0 for op in TIMED_OPS}
+        self.lastPathLength = 0
+        self.wrapped = []
+
+
+def timed_op(stats, op, fn):
+    """
+    Wrap fn to record the latency of its outermost calls in stats
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        stats.depth[op] += 1
+        start = time.perf_counter_ns()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            stats.depth[op] -= 1
+            if stats.depth[op] == 0:
+                elapsed = time.perf_counter_ns() - start
+                stats.latency[op][max(elapsed, 1).bit_length() - 1] += 1
+                stats.latencyTotal[op] += elapsed
+    return wrapper
+
+
+def enable_stats(acf, wrap=None):
+    """
+    Instrument one filter instance, resetting its stats if already enabled.
+    wrap(acf, stats) returns the wrappers to install by method name, by default
+    supported_wrappers.
+    """
+    disable_stats(acf)
+    stats = Stats()
+    wrappers = (wrap or supported_wrappers)(acf, stats)
+
+    for name, wrapper in wrappers.items():
+        setattr(acf, name, wrapper)
+    stats.wrapped = list(wrappers)
+    acf.instrumentation = stats
+
+
+def counted_path(acf, stats):
+    """
+    Wrap find_insertion_path to count expanded nodes and path lengths
+    """
+    find_insertion_path = acf.find_insertion_path
+
+    def wrapper(x, *args, **kwargs):
+        path = find_insertion_path(x, *args, **kwargs)
+        stats.bfsNodes += acf.lastPathNodes
+        stats.lastPathLength = 0 if path is False else len(path)
+        if path is not False:
+            stats.pathLength[len(path)] += 1
+        return path
+    return timed_op(stats, "find_insertion_path", wrapper)
+
+
+def supported_wrappers(acf, stats):
+    """
+    Wrappers of a supported_adaptations.ACF
+    """
+    wrappers = dict()
+
+    compute_key_hashes = acf.compute_key_hashes
+
+    def counted_key_hashes(x):
+        stats.hashComputations += acf.d
+        return compute_key_hashes(x)
+    wrappers["compute_key_hashes"] = counted_key_hashes
+
+    block_hash = acf.block_hash
+
+    def counted_block_hash(x, i):
+        stats.hashComputations += 1
+        return block_hash(x, i)
+    wrappers["block_hash"] = counted_block_hash
+
+    fingerprint = acf.fingerprint
+
+    def counted_fingerprint(x):
+        # With the hash cache the fingerprint comes from compute_key_hashes
+        if acf.hashCache is None:
+            stats.hashComputations += 1
+        return fingerprint(x)
+    wrappers["fingerprint"] = counted_fingerprint
+
+    wrappers["find_insertion_path"] = counted_path(acf, stats)
+
+    insert = acf.insert
+
+    def counted_insert(x, *args, **kwargs):
+        inserted = insert(x, *args, **kwargs)
+        if inserted:
+            stats.relocations[stats.lastPathLength - 1] += 1
+        else:
+            stats.insertFailures += 1
+        return inserted
+    wrappers["insert"] = timed_op(stats, "insert", counted_insert)
+
+    wrappers["check_membership"] = timed_op(
+        stats, "check_membership", acf.check_membership)
+
+    adapt_false_positive = acf.adapt_false_positive
+
+    def counted_adapt(false_x, *args, **kwargs):
+        outcome = adapt_false_positive(false_x, *args, **kwargs)
+        stats.adaptDepth[acf.lastAdaptRetries] += 1
+        stats.adaptOutcomes[outcome.name] += 1
+        if not outcome:
+            stats.adaptFailures += 1
+        return outcome
+    wrappers["adapt_false_positive"] = timed_op(
+        stats, "adapt_false_positive", counted_adapt)
+
+    return wrappers
+
+
+def firewall_wrappers(acf, stats):
+    """
+    Wrappers of an acf_firewall.ACF, whose insert returns False on success and
+    the rejected element otherwise
+    """
+    wrappers = dict()
+
+    compute_key_hashes = acf.compute_key_hashes
+
+    def counted_key_hashes(x):
+        stats.hashComputations += 1
+        return compute_key_hashes(x)
+    wrappers["compute_key_hashes"] = counted_key_hashes
+
+    check_membership_batch = acf.check_membership_batch
+
+    def counted_membership_batch(xs):
+        stats.hashComputations += len(xs)
+        return check_membership_batch(xs)
+    wrappers["check_membership_batch"] = counted_membership_batch
+
+    wrappers["find_insertion_path"] = counted_path(acf, stats)
+
+    insert = acf.insert
+
+    def counted_insert(x):
+        stashSize = len(acf.stash)
+        rejected = insert(x)
+        if rejected is False:
+            stats.relocations[acf.lastRelocations] += 1
+            if len(acf.stash) > stashSize:
+                stats.stashed += 1
+        else:
+            stats.insertFailures += 1
+        return rejected
+    wrappers["insert"] = timed_op(stats, "insert", counted_insert)
+
+    wrappers["check_membership"] = timed_op(
+        stats, "check_membership", acf.check_membership)
+    wrappers["adapt_false_positive"] = timed_op(
+        stats, "adapt_false_positive", acf.adapt_false_positive)
+
+    return wrappers
+
+
+def disable_stats(acf):
+    """
+    Remove the instrumentation of a filter instance
+    """
+    strip_stats(acf.__dict__)
+
+
+def strip_stats(state):
+    """
+    Drop the instrumentation from an instance __dict__ (clones, pickling)
+    """
+    stats = state.get("instrumentation")
+    if stats is None:
+        return
+    for name in stats.wrapped:
+        state.pop(name, None)
+    state["instrumentation"] = None
+
+
+def stats(acf):
+    """
+    Snapshot of the counters of an instrumented filter, None when stats are off
+    """
+    stats = getattr(acf, "instrumentation", None)
+    if stats is None:
+        return None
+    return {
+        "hash_computations": stats.hashComputations,
+        "bfs_nodes": stats.bfsNodes,
+        "path_length": dict(sorted(stats.pathLength.items())),
+        "relocations": dict(sorted(stats.relocations.items())),
+        "adapt_depth": dict(sorted(stats.adaptDepth.items())),
+        "adapt_outcomes": dict(stats.adaptOutcomes),
+        "insert_failures": stats.insertFailures,
+        "adapt_failures": stats.adaptFailures,
+        "stashed": stats.stashed,
+        "latency": {op: {"count": sum(stats.latency[op].values()),
+                         "total_ns": stats.latencyTotal[op],
+                         "log2_ns": dict(sorted(stats.latency[op].items()))}
+                    for op in TIMED_OPS},
+    }
@@ -0,0 +1,62 @@
+"""
+Seeded bulk generation of random 104-bit keys
+
+Keys are drawn as (N, 13) uint8 arrays, the little-endian bytes of each key (the
+layout of crc_hash.keys_to_array and of the 5-tuples in a trace), so they can be
+hashed with the vectorized CRC directly. array_to_keys gives the int view.
+"""
+
+import numpy as np
+
+from crc_hash import KEY_BYTES, array_to_keys
+
+DEFAULT_BATCH = 1 << 14
+
+
+def random_keys(n, seed=None):
+    """
+    n unique, nonzero random keys as an (n, 13) uint8 array. seed is anything
+    np.random.default_rng accepts (int, SeedSequence, Generator, None).
+    """
+    rng = np.random.default_rng(seed)
+    keys = rng.integers(0, 256, size=(n, KEY_BYTES), dtype=np.uint8)
+
+    # Redraw duplicate (and all-zero) rows until every key is unique
+    while n > 0:
+        rows = np.ascontiguousarray(keys).view(
+            np.dtype((np.void, KEY_BYTES))).ravel()
+        _, first = np.unique(rows, return_index=True)
+        redraw = np.ones(n, dtype=bool)
+        redraw[first] = False
+        redraw |= ~keys.any(axis=1)
+        if not redraw.any():
+            break
+        keys[redraw] = rng.integers(0, 256, size=(int(redraw.sum()), KEY_BYTES),
+                                    dtype=np.uint8)
+    return keys
+
+
+class KeyStream():
+    """
+    Unbounded stream of unique int keys, drawn from random_keys in batches.
+    Use random_keys directly when the number of keys is known.
+    """
+
+    def __init__(self, seed=None, batch=DEFAULT_BATCH):
+        self.rng = np.random.default_rng(seed)
+        self.batch = batch
+        self.seen = set()
+        self.pending = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            if not self.pending:
+                self.pending = array_to_keys(random_keys(self.batch, self.rng))
+                self.pending.reverse()
+            x = self.pending.pop()
+            if x not in self.seen:
+                self.seen.add(x)
+                return x
@@ -1,275 +1,76 @@
 import struct
 import math
-import random
-import crcmod
 import numpy as np
 import pathlib
 import json
+import argparse
+import multiprocessing
+import os
 
-"""
-Generate a random MAC address.
-"""
+from supported_adaptations import ACF
+from key_stream import random_keys
+from crc_hash import array_to_keys
 
 
-def randomSrc():
-    return random.randint(1, 2**104)
-
-
-""" 
-Compute the fingerprint for a given MAC address
-"""
-
-
-"""
-Generate fingerprint from int representing 5-tuple
-"""
-
-
-def crc_from_eth(src, fingerprintLength):
-    hash2_func = crcmod.predefined.mkCrcFun('crc-32-bzip2')
-    # src_hex = int(src[6:17].replace(":", ""), 16)
-    return hash2_func(src.to_bytes(13, "little")) & fingerprintLength
-
-
-class ACF():
-    def __init__(self, d, b, c, fingerprintLength):
-        self.fingerprintLength = fingerprintLength
-        self.c = c
-        self.bexp = b
-        self.b = b
-        self.d = d
-        self.tables = np.full((d, self.b, self.c), None, dtype=object).tolist()
-        self.backup = np.full((d, self.b, self.c), None, dtype=object).tolist()
-
-    """
-    Compute the bucket index for a given fingerprint and table index
-    """
-
-    def block_hash(self, x, i):
-        hash2_func = crcmod.predefined.mkCrcFun('crc-32-bzip2')
-        srcByteString = x.to_bytes(13, "little")
-        rotatedByteString = srcByteString[i:] + srcByteString[:i]
-
-        if i == 0:
-            assert srcByteString == rotatedByteString
-            assert hash2_func(x.to_bytes(13, "little")) % self.b == hash2_func(
-                rotatedByteString) % self.b
-
-        """
-        if x == 477101476482349837267165074221 or x == 539758783583190476167677316429:
-            print(x)
-            print(i)
-            print(x.to_bytes(13, "little"), rotatedByteString)
-            print(hash2_func(x.to_bytes(13, "little")), hash2_func(rotatedByteString))
-            print(self.b)
-        """
-
-        return hash2_func(rotatedByteString) % self.b
-
-    """
-    Find an insertion path for x by running BFS. An insertion path represents all the entries that need to 
-    move in order to insert x.
-    Takes x, the item to insert, and badStates, a list of tables that already have false-positives.
-    Returns a list of table indices that represent the path to insert x.
-    """
-
-    def find_insertion_path(self, x, badStates=[][:]):
-        searchQueue = [[[x, badStates], []]]
-        for _ in range(0, 1000):
-            if len(searchQueue) < 1:
-                print("1000 iterations")
-                break
-
-            [[n, nbadStates], path] = searchQueue.pop(0)
-            # fingerprint = crc_from_eth(n, es)
-            for i in range(0, self.d):
-                if i in nbadStates:
-                    continue
-
-                # Calculate new path if we inserted into this table
-                h = self.block_hash(x, i)
-                newPath = path.copy()
-                newPath.append(i)
-
-                # If we found a free space, return the path so we can insert
-                if self.tables[i][h][0] is None:
-                    return newPath
-
-                # Otherwise, push to the queue so we can check the next degree
-                [newX, newBadStates] = self.backup[i][h][0]
-                searchQueue.append([[newX, newBadStates], newPath])
-
-        # No path found
-        return False
-
+def single_pass_trial(task):
     """
-    Calculate insertion path and execute insertion operations
+    Insert fresh keys into one filter until the first insertion failure.
+    Returns (achieved load in % of the filter's slots, BFS nodes expanded, keys inserted).
     """
+    s_count, c, seedSequence = task
 
-    def insert(self, x, badStates=[][:]):
-
-        insertionPath = self.find_insertion_path(x, badStates.copy())
-
-        if insertionPath is False:
-            return False
-
-        # Setup initial insertion
-        toInsert = [x, badStates.copy()]
-
-        # print(insertionPath)
-
-        for i in range(0, len(insertionPath)):
-
-            if toInsert is None:
-                break
-
-            # print(toInsert)
-
-            legTable = insertionPath[i]
-            toInsertFingerprint = crc_from_eth(
-                toInsert[0], self.fingerprintLength)
-            h = self.block_hash(toInsert[0], legTable)
-
-            toInsertTmp = None
-            if self.tables[legTable][h][0] is not None:
-                toInsertTmp = self.backup[legTable][h][0].copy()
-
-            self.tables[legTable][h][0] = toInsertFingerprint
-            self.backup[legTable][h][0] = toInsert.copy()
-
-            toInsert = toInsertTmp
-
-        return True
-
-    """ Search tables for fingerprint and return indices """
+    testCuckoo = ACF(s_count, int(filterSize/(s_count*c)), c, 0xff)
+    capacity = testCuckoo.d * testCuckoo.b * testCuckoo.c
 
-    def membership_index(self, x):
-        fingerprint = crc_from_eth(x, self.fingerprintLength)
-        for i in range(0, self.d):
-            b = self.block_hash(x, i)
-            for j in range(0, self.c):
-                if self.tables[i][b][j] == fingerprint:
-                    return (i, b, j)
-        return False
+    inserted = 0
+    for x in array_to_keys(random_keys(capacity, seedSequence)):
+        if not testCuckoo.insert(x):
+            break
+        inserted += 1
 
-    """ Returns true/false if x in ACF """
-
-    def check_membership(self, x):
-        membership_index = self.membership_index(x)
-        if membership_index == False:
-            return False
-        return True
-
-    """ Swaps collision of false_x with different item in same block """
-
-    def adapt_false_positive(self, false_x):
-
-        membershipIndex = self.membership_index(false_x)
-
-        if membershipIndex == False:
-            raise "False positive not in ACF"
-
-        (h, b, c) = membershipIndex
-        [x, xBadStates] = self.backup[h][b][c]
-
-        """
-        print(x, false_x)
-        print(x.to_bytes(13, "little"), false_x.to_bytes(13, "little"))
-        
-        print(crc_from_eth(x), crc_from_eth(false_x))
-        print(crc_from_eth(x + 2), crc_from_eth(false_x + 2))
-
-        print(self.block_hash(x, 0), self.block_hash(false_x, 0))
-        print(self.block_hash(x, 3), self.block_hash(false_x, 3))
-        print(self.b)
-        """
-
-        # Mark current position as bad
-        xBadStates.append(h)
-
-        # Remove from current position
-        self.backup[h][b][c] = None
-        self.tables[h][b][c] = None
-
-        # Reinsert to try to find new position
-        insertSuccess = self.insert(x, xBadStates.copy())
-
-        # Make sure we've resolve the conflict or retry
-        if not insertSuccess:
-            return insertSuccess
-
-        if self.check_membership(false_x) == True:
-            return self.adapt_false_positive(false_x)
-
-        return True
-
-    """
-    Print current state of the filter tables.
-    """
-
-    def printState(self):
-        print(self.tables)
-        print(self.backup)
-
-    """
-    Count items in filter. Useful as sanity check.
-    """
-
-    def countOccupancy(self):
-        count = 0
-        for i in range(0, self.d):
-            for j in range(0, self.b):
-                for k in range(0, self.c):
-                    if self.tables[i][j][k] is not None:
-                        count += 1
-        print("Occupancy is: " + str(count))
-
-    """
-    Print the occupancy of each stage in the filter
-    """
-
-    def occupancy_stats(self):
-        per_table = []
-        for i in range(0, self.d):
-            total = 0
-            full = 0
-            for j in range(0, self.b):
-                for k in range(0, self.c):
-                    total += 1
-                    if self.tables[i][j][k] is not None:
-                        full += 1
-            per_table.append((total, full))
-        print(per_table)
-
-    """
-    Get delta between CuckooFilter and tofino register state. Used to update tofino registers.
-    """
-
-    def getDelta(self, regState):
-        delta = []
-        for i in range(0, self.d):
-            for j in range(0, self.b):
-                tableVal = self.tables[i][j][0]
-                if tableVal is None:
-                    tableVal = 0
-
-                if not tableVal == regState[i][j]:
-                    delta.append((i, j, tableVal // 4))
-        return delta
-
-
-configurations = [(2, 7, 1), (3, 7, 1), (4, 7, 1),
-                  (5, 7, 1), (3, 8, 1), (3, 9, 1), (3, 10, 1)]
+    return 100 * inserted / capacity, testCuckoo.pathNodesExpanded, inserted
 
 
 filterSize = 2048
 iterations = 10
+stage_counts = [2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16]
 if __name__ == "__main__":
-
-    for s_count in [2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16]:
+    parser = argparse.ArgumentParser(
+        description="Measure maximum occupancy of the ACF for each number of stages")
+    parser.add_argument('-c', type=int, default=1,
+                        help="number of slots per bucket")
+    parser.add_argument('--single-pass', dest='single_pass', action='store_true',
+                        help="fill one filter per trial until the first insertion failure instead of binary searching the occupancy")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="worker processes running the single-pass trials")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="root seed of the single-pass trials")
+    args = parser.parse_args()
+
+    singlePassResults = dict()
+    if args.single_pass:
+        # Every (s_count, trial) gets an independent stream spawned from the root seed
+        seedSequences = np.random.SeedSequence(args.seed).spawn(
+            len(stage_counts) * iterations)
+        tasks = [(s_count, args.c, seedSequences[n * iterations + trial])
+                 for n, s_count in enumerate(stage_counts)
+                 for trial in range(iterations)]
+        with multiprocessing.Pool(args.workers) as pool:
+            trials = pool.map(single_pass_trial, tasks)
+        for n, s_count in enumerate(stage_counts):
+            singlePassResults[s_count] = trials[n * iterations:(n + 1) * iterations]
+
+    for s_count in stage_counts:
         occupancy_result = []
+        nodesExpanded = 0
+        inserted = 0
+
+        for (load, trialNodes, trialInserted) in singlePassResults.get(s_count, []):
+            occupancy_result.append(load)
+            nodesExpanded += trialNodes
+            inserted += trialInserted
 
-        for _ in range(0, iterations):
+        for _ in range(0, 0 if args.single_pass else iterations):
             left = 0
             right = 99
 
@@ -283,20 +84,21 @@ if __name__ == "__main__":
 
                 # Create new filter
                 testCuckoo = ACF(
-                    s_count, int(filterSize/s_count), 1, 0xff)
+                    s_count, int(filterSize/(s_count*args.c)), args.c, 0xff)
 
                 # Insert items until we reach the desired occupancy
                 achievedCapacity = True
                 n_insert = int(filterSize*estimate/100)
-                i_st = set()
-
-                while len(i_st) < n_insert:
-                    x = randomSrc()
-                    i_st.add(x)
+                i_st = array_to_keys(random_keys(n_insert))
 
+                for x in i_st:
                     if not testCuckoo.insert(x):
                         achievedCapacity = False
                         break
+                    # Only keys actually inserted, as in single_pass_trial
+                    inserted += 1
+
+                nodesExpanded += testCuckoo.pathNodesExpanded
 
                 if not achievedCapacity:
                     right = estimate
@@ -305,6 +107,10 @@ if __name__ == "__main__":
 
         print(s_count, sum(occupancy_result) /
               len(occupancy_result), occupancy_result)
+        print("BFS nodes expanded per insert:", nodesExpanded / max(inserted, 1))
 
-        pathlib.Path("param_results/stages{}.json".format(s_count)).write_text(json.dumps((s_count, sum(occupancy_result) /
+        # Single-slot results keep their original file names
+        resultName = "stages{}".format(s_count) if args.c == 1 else \
+            "stages{}_c{}".format(s_count, args.c)
+        pathlib.Path("param_results/{}.json".format(resultName)).write_text(json.dumps((s_count, sum(occupancy_result) /
                                                                                   len(occupancy_result), occupancy_result)))
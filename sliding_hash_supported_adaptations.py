@@ -1,9 +1,10 @@
 import struct
 import math
 import random
-import crcmod
 import numpy as np
 
+from crc_hash import crc32_bzip2
+
 """
 Generate a random MAC address.
 """
@@ -22,9 +23,8 @@ Compute the fingerprint for a given MAC address
 
 
 def crc_from_eth(src):
-    hash2_func = crcmod.predefined.mkCrcFun('crc-32-bzip2')
     src_hex = int(src[6:17].replace(":", ""), 16)
-    return hash2_func(struct.pack("!I", src_hex)) & 0xffff
+    return crc32_bzip2(struct.pack("!I", src_hex)) & 0xffff
 
 
 """
@@ -55,8 +55,7 @@ class CuckooFilter():
     """
 
     def block_hash(self, fingerprint, i):
-        hash2_func = crcmod.predefined.mkCrcFun('crc-32-bzip2')
-        return hash2_func(struct.pack("!I", fingerprint + i)) % self.b
+        return crc32_bzip2(struct.pack("!I", fingerprint + i)) % self.b
 
     """
     Calculate block hash and insert if space in bucket
@@ -176,66 +175,67 @@ class CuckooFilter():
 
 configurations = [(1, 7, 8)]
 
-# For each configuration
-for configuration in configurations:
-    print("Configuration: ", configuration)
+if __name__ == "__main__":
+    # For each configuration
+    for configuration in configurations:
+        print("Configuration: ", configuration)
+
+        # For occupancy between 10% and 99%
+        for occupancyRate in range(10, 99):
+            achievedFalsePositives = []
+            capacity = configuration[0]*pow(2, configuration[1])*configuration[2]
+            occupancy = occupancyRate * capacity*0.01
 
-    # For occupancy between 10% and 99%
-    for occupancyRate in range(10, 99):
-        achievedFalsePositives = []
-        capacity = configuration[0]*pow(2, configuration[1])*configuration[2]
-        occupancy = occupancyRate * capacity*0.01
+            print(occupancy, capacity)
 
-        print(occupancy, capacity)
+            # Run test up to five times
+            for _ in range(0, 5):
 
-        # Run test up to five times
-        for _ in range(0, 5):
+                # Create new filter
+                testCuckoo = CuckooFilter(
+                    configuration[0], configuration[1], configuration[2])
 
-            # Create new filter
-            testCuckoo = CuckooFilter(
-                configuration[0], configuration[1], configuration[2])
+                # Track items we insert into the filter
+                src_lst = []
 
-            # Track items we insert into the filter
-            src_lst = []
+                # Insert items until we reach the desired occupancy
+                achievedCapacity = True
+                for _ in range(0, math.floor(occupancy)):
+                    x = randomSrc()
+                    src_lst.append(x)
+                    if not testCuckoo.insert(x):
+                        achievedCapacity = False
+                        break
 
-            # Insert items until we reach the desired occupancy
-            achievedCapacity = True
-            for _ in range(0, math.floor(occupancy)):
-                x = randomSrc()
-                src_lst.append(x)
-                if not testCuckoo.insert(x):
-                    achievedCapacity = False
-                    break
+                if not achievedCapacity:
+                    continue
 
-            if not achievedCapacity:
-                continue
+                # Simulate and count supported false positive adaptations
+                falsePositives = 0
+                while True:
+                    x = src_lst[falsePositives % len(src_lst)]
 
-            # Simulate and count supported false positive adaptations
-            falsePositives = 0
-            while True:
-                x = src_lst[falsePositives % len(src_lst)]
+                    adapted = True
 
-                adapted = True
+                    while True:
+                        if not testCuckoo.adapt_false_positive(x):
+                            adapted = False
+                            break
 
-                while True:
-                    if not testCuckoo.adapt_false_positive(x):
-                        adapted = False
-                        break
+                        # Simulate adaptation where 1/2 of the time it still collides with the same item (since we adjust only one bit)
+                        if random.randint(0, 1) == 0:
+                            break
 
-                    # Simulate adaptation where 1/2 of the time it still collides with the same item (since we adjust only one bit)
-                    if random.randint(0, 1) == 0:
+                    if not adapted:
                         break
 
-                if not adapted:
-                    break
-
-                falsePositives += 1
+                    falsePositives += 1
 
-            achievedFalsePositives.append(falsePositives)
+                achievedFalsePositives.append(falsePositives)
 
-        # If we didn't reach the desired occupancy for more than 1/5 of the runs, complete the configuration
-        if len(achievedFalsePositives) < 4:
-            break
+            # If we didn't reach the desired occupancy for more than 1/5 of the runs, complete the configuration
+            if len(achievedFalsePositives) < 4:
+                break
 
-        print(capacity, math.floor(occupancy), len(achievedFalsePositives), np.mean(achievedFalsePositives),
-              np.std(achievedFalsePositives))
+            print(capacity, math.floor(occupancy), len(achievedFalsePositives), np.mean(achievedFalsePositives),
+                  np.std(achievedFalsePositives))
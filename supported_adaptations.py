@@ -1,20 +1,13 @@
 import struct
 import math
-import random
-import crcmod
+import copy
 import numpy as np
+from collections import OrderedDict, deque
+from enum import Enum
 
-
-"""
-Generate a random MAC address.
-"""
-
-
-def randomSrc():
-    components = []
-    for _ in range(30):
-        components.append(str(random.randint(1, 9)))
-    return int("".join(components))
+import instrumentation
+from key_stream import random_keys, KeyStream
+from crc_hash import crc32_bzip2, crc_rotated, crc_all_rotations, rotated_crc32_bzip2, array_to_keys
 
 
 """ 
@@ -28,80 +21,206 @@ Generate fingerprint from int representing 5-tuple
 
 
 def crc_from_eth(src, fingerprintLength):
-    hash2_func = crcmod.predefined.mkCrcFun('crc-32-bzip2')
     # src_hex = int(src[6:17].replace(":", ""), 16)
-    return hash2_func(src.to_bytes(13, "little")) & fingerprintLength
+    return crc32_bzip2(src.to_bytes(13, "little")) & fingerprintLength
+
+
+"""
+Pick the smallest unsigned dtype that can hold every fingerprint plus a reserved empty value
+"""
+
+
+def fingerprint_dtype(fingerprintLength):
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if np.iinfo(dtype).max > fingerprintLength:
+            return dtype
+    raise ValueError("Fingerprint length does not fit in 64 bits")
+
+
+class AdaptOutcome(Enum):
+    """
+    Result of ACF.adapt_false_positive. Truthy when the false positive is gone.
+    """
+    RESOLVED = "resolved"
+    NOT_PRESENT = "not present"
+    EXHAUSTED = "exhausted"
+    REINSERT_FAILED = "reinsert failed"
+
+    def __bool__(self):
+        return self in (AdaptOutcome.RESOLVED, AdaptOutcome.NOT_PRESENT)
 
 
 class ACF():
-    def __init__(self, d, b, c, fingerprintLength):
+    """
+    storage="list" keeps fingerprints in nested Python lists with None for empty slots.
+    storage="array" keeps them in a contiguous (d, b, c) unsigned NumPy array where the
+    dtype's max value marks an empty slot.
+    hashCacheSize > 0 memoizes each key's d bucket indices and fingerprint in an
+    LRU cache of that many keys.
+    maxPathNodes bounds the number of nodes the insertion path BFS may expand.
+    """
+
+    def __init__(self, d, b, c, fingerprintLength, storage="list", hashCacheSize=0, maxPathNodes=1000,
+                 trackDelta=False, maxAdaptRetries=1000):
         self.fingerprintLength = fingerprintLength
         self.c = c
         self.bexp = b
         self.b = b
         self.d = d
-        self.tables = np.full((d, self.b, self.c), None, dtype=object).tolist()
+        self.storage = storage
+        if storage == "array":
+            dtype = fingerprint_dtype(fingerprintLength)
+            self.empty = int(np.iinfo(dtype).max)
+            self.tables = np.full((d, self.b, self.c), self.empty, dtype=dtype)
+        elif storage == "list":
+            self.empty = None
+            self.tables = np.full(
+                (d, self.b, self.c), None, dtype=object).tolist()
+        else:
+            raise ValueError("Unknown storage mode: " + str(storage))
         self.backup = np.full((d, self.b, self.c), None, dtype=object).tolist()
+        self.sharedStorage = False
+
+        # Register value of every slot written since the last drain_delta, as it was
+        # before the first write. None when delta tracking is off.
+        self.dirtySlots = dict() if trackDelta else None
+
+        self.hashCacheSize = hashCacheSize
+        self.hashCache = OrderedDict() if hashCacheSize > 0 else None
+        self.hashCacheHits = 0
+        self.hashCacheMisses = 0
+
+        self.maxPathNodes = maxPathNodes
+        self.lastPathNodes = 0
+        self.pathNodesExpanded = 0
+
+        self.maxAdaptRetries = maxAdaptRetries
+        self.lastAdaptRetries = 0
+
+        # Set by enable_stats, see instrumentation.py
+        self.instrumentation = None
 
     """
     Compute the bucket index for a given fingerprint and table index
     """
 
     def block_hash(self, x, i):
-        hash2_func = crcmod.predefined.mkCrcFun('crc-32-bzip2')
-        srcByteString = x.to_bytes(13, "little")
-        rotatedByteString = srcByteString[i:] + srcByteString[:i]
+        return crc_rotated(x, i) % self.b
+
+    """
+    Compute the bucket indices of x for every table and its fingerprint
+    """
+
+    def compute_key_hashes(self, x):
+        crcs = crc_all_rotations(x, self.d)
+        return (tuple(crc % self.b for crc in crcs), crcs[0] & self.fingerprintLength)
+
+    """
+    Return (bucket indices, fingerprint) of x, going through the LRU hash cache when enabled
+    """
+
+    def key_hashes(self, x):
+        if self.hashCache is None:
+            return self.compute_key_hashes(x)
+
+        entry = self.hashCache.get(x)
+        if entry is not None:
+            self.hashCache.move_to_end(x)
+            self.hashCacheHits += 1
+            return entry
+
+        self.hashCacheMisses += 1
+        entry = self.compute_key_hashes(x)
+        self.hashCache[x] = entry
+        if len(self.hashCache) > self.hashCacheSize:
+            self.hashCache.popitem(last=False)
+        return entry
 
-        if i == 0:
-            assert srcByteString == rotatedByteString
-            assert hash2_func(x.to_bytes(13, "little")) % self.b == hash2_func(rotatedByteString) % self.b
+    """
+    Single bucket index and fingerprint lookups, cached when the hash cache is enabled
+    """
 
-        """
-        if x == 477101476482349837267165074221 or x == 539758783583190476167677316429:
-            print(x)
-            print(i)
-            print(x.to_bytes(13, "little"), rotatedByteString)
-            print(hash2_func(x.to_bytes(13, "little")), hash2_func(rotatedByteString))
-            print(self.b)
-        """
+    def bucket_index(self, x, i):
+        if self.hashCache is None:
+            return self.block_hash(x, i)
+        return self.key_hashes(x)[0][i]
 
-        return hash2_func(rotatedByteString) % self.b
+    def fingerprint(self, x):
+        if self.hashCache is None:
+            return crc_from_eth(x, self.fingerprintLength)
+        return self.key_hashes(x)[1]
+
+    """
+    Hash cache counters
+    """
+
+    def hash_cache_stats(self):
+        return {"hits": self.hashCacheHits, "misses": self.hashCacheMisses,
+                "size": len(self.hashCache) if self.hashCache is not None else 0,
+                "capacity": self.hashCacheSize}
 
     """
     Find an insertion path for x by running BFS. An insertion path represents all the entries that need to 
     move in order to insert x.
     Takes x, the item to insert, and badStates, a list of tables that already have false-positives.
-    Returns a list of table indices that represent the path to insert x.
+    Returns a list of (table, slot) legs that represent the path to insert x; the last leg is a free slot.
+    Each (table, bucket) is visited at most once and every occupant of a full bucket is a candidate
+    victim. The number of expanded nodes is recorded in lastPathNodes.
     """
 
     def find_insertion_path(self, x, badStates=[][:]):
-        searchQueue = [[[x, badStates], []]]
-        for _ in range(0, 1000):
-            if len(searchQueue) < 1:
-                print("1000 iterations")
-                break
-
-            [[n, nbadStates], path] = searchQueue.pop(0)
-            # fingerprint = crc_from_eth(n, es)
+        # Nodes are (key, badStates, (table, slot) it would leave, parent node); the root has no leg
+        nodes = [(x, badStates, None, -1)]
+        searchQueue = deque([0])
+        visited = set()
+        expanded = 0
+        insertionPath = False
+
+        while searchQueue and expanded < self.maxPathNodes:
+            nodeIndex = searchQueue.popleft()
+            (n, nbadStates, _, _) = nodes[nodeIndex]
+            expanded += 1
+
+            buckets = self.key_hashes(n)[0]
             for i in range(0, self.d):
                 if i in nbadStates:
                     continue
 
-                # Calculate new path if we inserted into this table
-                h = self.block_hash(x, i)
-                newPath = path.copy()
-                newPath.append(i)
+                h = buckets[i]
+                if (i, h) in visited:
+                    continue
+                visited.add((i, h))
+
+                bucket = self.tables[i][h]
+                freeSlot = None
+                for k in range(0, self.c):
+                    if bucket[k] == self.empty:
+                        freeSlot = k
+                        break
+
+                # If we found a free space, walk the parents back to build the path
+                if freeSlot is not None:
+                    insertionPath = [(i, freeSlot)]
+                    while nodeIndex > 0:
+                        (_, _, leg, nodeIndex) = nodes[nodeIndex]
+                        insertionPath.append(leg)
+                    insertionPath.reverse()
+                    break
+
+                # Otherwise, queue every occupant so we can check the next degree
+                for k in range(0, self.c):
+                    [newX, newBadStates] = self.backup[i][h][k]
+                    nodes.append((newX, newBadStates, (i, k), nodeIndex))
+                    searchQueue.append(len(nodes) - 1)
 
-                # If we found a free space, return the path so we can insert
-                if self.tables[i][h][0] is None:
-                    return newPath
+            if insertionPath is not False:
+                break
 
-                # Otherwise, push to the queue so we can check the next degree
-                [newX, newBadStates] = self.backup[i][h][0]
-                searchQueue.append([[newX, newBadStates], newPath])
+        self.lastPathNodes = expanded
+        self.pathNodesExpanded += expanded
 
-        # No path found
-        return False
+        # False if no path was found
+        return insertionPath
 
     """
     Calculate insertion path and execute insertion operations
@@ -109,44 +228,45 @@ class ACF():
 
     def insert(self, x, badStates=[][:]):
 
-        insertionPath = self.find_insertion_path(x, badStates.copy())
+        insertionPath = self.find_insertion_path(x, badStates)
 
         if insertionPath is False:
             return False
 
+        self._own_storage()
+
         # Setup initial insertion
         toInsert = [x, badStates.copy()]
 
         # print(insertionPath)
 
-        for i in range(0, len(insertionPath)):
+        for (legTable, legSlot) in insertionPath:
 
             if toInsert is None:
                 break
 
             # print(toInsert)
 
-            legTable = insertionPath[i]
-            toInsertFingerprint = crc_from_eth(toInsert[0], self.fingerprintLength)
-            h = self.block_hash(toInsert[0], legTable)
+            toInsertFingerprint = self.fingerprint(toInsert[0])
+            h = self.bucket_index(toInsert[0], legTable)
 
             toInsertTmp = None
-            if self.tables[legTable][h][0] is not None:
-                toInsertTmp = self.backup[legTable][h][0].copy()
+            if self.tables[legTable][h][legSlot] != self.empty:
+                toInsertTmp = self.backup[legTable][h][legSlot].copy()
 
-            self.tables[legTable][h][0] = toInsertFingerprint
-            self.backup[legTable][h][0] = toInsert.copy()
+            self.set_slot(legTable, h, legSlot,
+                          toInsertFingerprint, toInsert.copy())
 
             toInsert = toInsertTmp
 
         return True
 
-    """ Search tables for fingerprint and return indices """
+    """ Search tables for fingerprint and return indices (hashes: key_hashes(x) if already known) """
 
-    def membership_index(self, x):
-        fingerprint = crc_from_eth(x, self.fingerprintLength)
+    def membership_index(self, x, hashes=None):
+        (buckets, fingerprint) = self.key_hashes(x) if hashes is None else hashes
         for i in range(0, self.d):
-            b = self.block_hash(x, i)
+            b = buckets[i]
             for j in range(0, self.c):
                 if self.tables[i][b][j] == fingerprint:
                     return (i, b, j)
@@ -160,48 +280,175 @@ class ACF():
             return False
         return True
 
-    """ Swaps collision of false_x with different item in same block """
+    """
+    Fingerprint table as a (d, b, c) array with self.empty replaced by the dtype's max value.
+    Array storage is returned as-is, list storage is converted.
+    """
+
+    def fingerprint_array(self):
+        if self.storage == "array":
+            return self.tables
+
+        dtype = fingerprint_dtype(self.fingerprintLength)
+        table = np.full((self.d, self.b, self.c),
+                        np.iinfo(dtype).max, dtype=dtype)
+        for i in range(0, self.d):
+            for j in range(0, self.b):
+                for k in range(0, self.c):
+                    if self.tables[i][j][k] is not None:
+                        table[i, j, k] = self.tables[i][j][k]
+        return table
+
+    """
+    Batched check_membership over an (N, 13) uint8 array of keys (the little-endian
+    bytes of each key). Returns a boolean array and the (stage, bucket, slot) index
+    arrays of the first match, with -1 where the key is not a member.
+    """
+
+    def check_membership_batch(self, keys, batchSize=1 << 16):
+        keys = np.ascontiguousarray(keys, dtype=np.uint8).reshape(-1, 13)
+        n = keys.shape[0]
+        table = self.fingerprint_array()
+        stages = np.arange(self.d)[:, None]
+
+        found = np.zeros(n, dtype=bool)
+        stage = np.full(n, -1, dtype=np.int64)
+        bucket = np.full(n, -1, dtype=np.int64)
+        slot = np.full(n, -1, dtype=np.int64)
+
+        for start in range(0, n, batchSize):
+            end = min(start + batchSize, n)
+            crcs = rotated_crc32_bzip2(keys[start:end], self.d)
+            fingerprints = crcs[0] & np.uint32(self.fingerprintLength)
+            buckets = (crcs % np.uint32(self.b)).astype(np.int64)
+
+            # (d, N, c) gather of every candidate slot, flattened to stage-major order
+            matches = table[stages, buckets] == fingerprints[None, :, None]
+            matches = matches.transpose(1, 0, 2).reshape(end - start, -1)
+            hit = matches.any(axis=1)
+            first = matches.argmax(axis=1)
+            hitStage = first // self.c
+
+            found[start:end] = hit
+            stage[start:end] = np.where(hit, hitStage, -1)
+            bucket[start:end] = np.where(
+                hit, buckets[hitStage, np.arange(end - start)], -1)
+            slot[start:end] = np.where(hit, first % self.c, -1)
+
+        return found, (stage, bucket, slot)
 
-    def adapt_false_positive(self, false_x):
+    """
+    Adapt to false positive false_x: move the item whose fingerprint collides with it
+    to another stage (marking its current stage bad) until false_x is no longer a
+    member, at most maxRetries times (self.maxAdaptRetries by default). The hashes of
+    false_x are computed once for all retries. Returns an AdaptOutcome.
+    """
 
-        membershipIndex = self.membership_index(false_x)
+    def adapt_false_positive(self, false_x, maxRetries=None):
+        if maxRetries is None:
+            maxRetries = self.maxAdaptRetries
+
+        falseHashes = self.key_hashes(false_x)
+        membershipIndex = self.membership_index(false_x, falseHashes)
+        self.lastAdaptRetries = 0
 
         if membershipIndex == False:
-            raise "False positive not in ACF"
+            return AdaptOutcome.NOT_PRESENT
+
+        while self.lastAdaptRetries < maxRetries:
+            self.lastAdaptRetries += 1
 
+            # Reinsert to try to find new position
+            if not self.relocate_colliding(membershipIndex):
+                return AdaptOutcome.REINSERT_FAILED
+
+            # Make sure we've resolved the conflict or retry
+            membershipIndex = self.membership_index(false_x, falseHashes)
+            if membershipIndex == False:
+                return AdaptOutcome.RESOLVED
+
+        return AdaptOutcome.EXHAUSTED
+
+    """
+    Remove the item at (h, b, c) and reinsert it with stage h marked bad.
+    Returns whether the reinsert succeeded (the item is dropped otherwise).
+    """
+
+    def relocate_colliding(self, membershipIndex):
         (h, b, c) = membershipIndex
         [x, xBadStates] = self.backup[h][b][c]
 
-        """
-        print(x, false_x)
-        print(x.to_bytes(13, "little"), false_x.to_bytes(13, "little"))
-        
-        print(crc_from_eth(x), crc_from_eth(false_x))
-        print(crc_from_eth(x + 2), crc_from_eth(false_x + 2))
+        # Mark current position as bad. Slot entries are shared with clones,
+        # so build a new list rather than appending in place.
+        xBadStates = xBadStates + [h]
+
+        # Remove from current position
+        self._own_storage()
+        self.set_slot(h, b, c, self.empty, None)
 
-        print(self.block_hash(x, 0), self.block_hash(false_x, 0))
-        print(self.block_hash(x, 3), self.block_hash(false_x, 3))
-        print(self.b)
-        """
+        return self.insert(x, xBadStates)
 
-        # Mark current position as bad
-        xBadStates.append(h)
+    """
+    Write a slot of table i, logging it for drain_delta when tracking is on
+    """
 
-        # Remove from current position
-        self.backup[h][b][c] = None
-        self.tables[h][b][c] = None
-
-        # Reinsert to try to find new position
-        insertSuccess = self.insert(x, xBadStates.copy())
-
-        # Make sure we've resolve the conflict or retry
-        if not insertSuccess:
-            return insertSuccess
-        
-        if self.check_membership(false_x) == True:
-            return self.adapt_false_positive(false_x)
-        
-        return True
+    def set_slot(self, i, j, k, fingerprint, entry):
+        if self.dirtySlots is not None and (i, j, k) not in self.dirtySlots:
+            self.dirtySlots[(i, j, k)] = self.register_value(self.tables[i][j][k])
+        self.tables[i][j][k] = fingerprint
+        self.backup[i][j][k] = entry
+
+    """
+    Independent copy of the filter, e.g. to fork several query phases off one fill.
+    Tables and backup are shared copy-on-write: the clone and the original both copy
+    them before their next write. Slot entries are never modified in place, so only
+    the containers are copied.
+    """
+
+    def clone(self):
+        clone = copy.copy(self)
+        instrumentation.strip_stats(clone.__dict__)
+        if self.dirtySlots is not None:
+            clone.dirtySlots = dict(self.dirtySlots)
+        if self.hashCache is not None:
+            clone.hashCache = OrderedDict(self.hashCache)
+        self.sharedStorage = True
+        clone.sharedStorage = True
+        return clone
+
+    def _own_storage(self):
+        if not self.sharedStorage:
+            return
+        if self.storage == "array":
+            self.tables = self.tables.copy()
+        else:
+            self.tables = [[list(bucket) for bucket in stage]
+                           for stage in self.tables]
+        self.backup = [[list(bucket) for bucket in stage]
+                       for stage in self.backup]
+        self.sharedStorage = False
+
+    def __getstate__(self):
+        # A pickled filter always gets its own storage
+        state = self.__dict__.copy()
+        state["sharedStorage"] = False
+        instrumentation.strip_stats(state)
+        return state
+
+    """
+    Hot-path counters and latency histograms, off by default. enable_stats
+    instruments this instance only (clones start without stats); stats returns
+    a snapshot, or None when stats are off.
+    """
+
+    def enable_stats(self):
+        instrumentation.enable_stats(self)
+
+    def disable_stats(self):
+        instrumentation.disable_stats(self)
+
+    def stats(self):
+        return instrumentation.stats(self)
 
     """
     Print current state of the filter tables.
@@ -216,11 +463,16 @@ class ACF():
     """
 
     def countOccupancy(self):
+        if self.storage == "array":
+            count = int(np.count_nonzero(self.tables != self.empty))
+            print("Occupancy is: " + str(count))
+            return
+
         count = 0
         for i in range(0, self.d):
             for j in range(0, self.b):
                 for k in range(0, self.c):
-                    if self.tables[i][j][k] is not None:
+                    if self.tables[i][j][k] != self.empty:
                         count += 1
         print("Occupancy is: " + str(count))
 
@@ -229,6 +481,11 @@ class ACF():
     """
 
     def occupancy_stats(self):
+        if self.storage == "array":
+            full = np.count_nonzero(self.tables != self.empty, axis=(1, 2))
+            print([(self.b * self.c, int(f)) for f in full])
+            return
+
         per_table = []
         for i in range(0, self.d):
             total = 0
@@ -236,84 +493,141 @@ class ACF():
             for j in range(0, self.b):
                 for k in range(0, self.c):
                     total += 1
-                    if self.tables[i][j][k] is not None:
+                    if self.tables[i][j][k] != self.empty:
                         full += 1
             per_table.append((total, full))
         print(per_table)
 
+    """
+    Value a table slot holds in the tofino register image (0 when empty)
+    """
+
+    def register_value(self, tableVal):
+        if tableVal == self.empty:
+            return 0
+        return int(tableVal)
+
+    """
+    Full (d, b * c) register image in the value encoding of getDelta
+    """
+
+    def register_image(self):
+        table = self.fingerprint_array()
+        image = np.where(table == np.iinfo(table.dtype).max, 0, table // 4)
+        return image.reshape(self.d, self.b * self.c).astype(np.uint32)
+
     """
     Get delta between CuckooFilter and tofino register state. Used to update tofino registers.
+    Slot k of bucket j is register j * c + k of its stage, so c=1 keeps one register per bucket.
     """
 
     def getDelta(self, regState):
         delta = []
         for i in range(0, self.d):
             for j in range(0, self.b):
-                tableVal = self.tables[i][j][0]
-                if tableVal is None:
-                    tableVal = 0
+                for k in range(0, self.c):
+                    tableVal = self.register_value(self.tables[i][j][k])
+
+                    if not tableVal == regState[i][j * self.c + k]:
+                        delta.append((i, j * self.c + k, tableVal // 4))
+        return delta
 
-                if not tableVal == regState[i][j]:
-                    delta.append((i, j, tableVal // 4))
+    """
+    Register updates for the slots changed since the last call, in getDelta's
+    (stage, index, value) encoding. Needs trackDelta=True (or start_delta_tracking,
+    which takes the current tables as already synced); cost is proportional to
+    the slots written, not to the filter size.
+    """
+
+    def start_delta_tracking(self):
+        self.dirtySlots = dict()
+
+    def drain_delta(self):
+        if self.dirtySlots is None:
+            raise ValueError("Delta tracking is off, construct the ACF with trackDelta=True")
+        delta = []
+        for (i, j, k), regVal in sorted(self.dirtySlots.items()):
+            tableVal = self.register_value(self.tables[i][j][k])
+            if not tableVal == regVal:
+                delta.append((i, j * self.c + k, tableVal // 4))
+        self.dirtySlots = dict()
         return delta
 
 
+def fill_checkpoints(acf, counts, newKey):
+    """
+    Grow acf with fresh keys from newKey() through the item counts in increasing order,
+    yielding (count, clone of acf, keys inserted so far) at each, so destructive
+    measurements can run on the clone while the fill continues. Stops at the first
+    insertion failure: later counts are not yielded.
+    """
+    keys = []
+    seen = set()
+    for count in sorted(counts):
+        while len(keys) < count:
+            x = newKey()
+            if x in seen:
+                continue
+            seen.add(x)
+            if not acf.insert(x):
+                return
+            keys.append(x)
+        yield count, acf.clone(), list(keys)
+
+
 configurations = [(2, 7, 1), (3, 7, 1), (4, 7, 1),
                   (5, 7, 1), (3, 8, 1), (3, 9, 1), (3, 10, 1)]
 
 if __name__ == "__main__":
-    # For each configuration
+    # For each configuration of (stages, log2 buckets per stage, slots per bucket)
     for configuration in configurations:
         print("Configuration: ", configuration)
 
-        # For occupancy between 10% and 99%
-        for occupancyRate in range(10, 99):
-            achievedFalsePositives = []
-            capacity = configuration[0] * \
-                pow(2, configuration[1])*configuration[2]
-            occupancy = occupancyRate * capacity*0.01
+        capacity = configuration[0] * \
+            pow(2, configuration[1])*configuration[2]
 
-            print(occupancy, capacity)
+        # Occupancy between 10% and 99%, as item counts
+        occupancies = {math.floor(occupancyRate * capacity*0.01): occupancyRate
+                       for occupancyRate in range(10, 99)}
+        achievedFalsePositives = {occupancy: [] for occupancy in occupancies}
 
-            # Run test up to five times
-            for _ in range(0, 5):
+        # Run test up to five times, filling one filter through every occupancy
+        for _ in range(0, 5):
 
-                # Create new filter
-                testCuckoo = ACF(
-                    configuration[0], configuration[1], configuration[2])
+            # Create new filter
+            testCuckoo = ACF(
+                configuration[0], pow(2, configuration[1]), configuration[2], 0xff)
 
-                # Track items we insert into the filter
-                src_lst = []
+            fillKeys = iter(array_to_keys(random_keys(max(occupancies))))
+            candidateKeys = KeyStream()
 
-                # Insert items until we reach the desired occupancy
-                achievedCapacity = True
-                for _ in range(0, math.floor(occupancy)):
-                    x = randomSrc()
+            for (occupancy, checkpoint, src_lst) in fill_checkpoints(testCuckoo, occupancies, fillKeys.__next__):
 
-                    src_lst.append(x)
-                    if not testCuckoo.insert(x):
-                        achievedCapacity = False
-                        break
-                if not achievedCapacity:
-                    continue
-
-                # Simulate and count supported false positive adaptations
+                # Simulate and count supported false positive adaptations on a clone.
+                # Inserted keys are true positives that adapting can never clear,
+                # so fresh keys that hit the filter are adapted.
+                inserted = set(src_lst)
                 falsePositives = 0
                 while True:
-                    x = src_lst[falsePositives % len(src_lst)]
+                    x = next(candidateKeys)
+                    if x in inserted or not checkpoint.check_membership(x):
+                        continue
 
-                    if not testCuckoo.adapt_false_positive(x):
+                    if not checkpoint.adapt_false_positive(x):
                         break
 
-                    assert testCuckoo.check_membership(x) == False
+                    assert checkpoint.check_membership(x) == False
 
                     falsePositives += 1
 
-                achievedFalsePositives.append(falsePositives)
+                achievedFalsePositives[occupancy].append(falsePositives)
+
+        for occupancy in sorted(occupancies):
+            print(occupancy, capacity)
 
             # If we didn't reach the desired occupancy for more than 1/5 of the runs, complete the configuration
-            if len(achievedFalsePositives) < 4:
+            if len(achievedFalsePositives[occupancy]) < 4:
                 break
 
-            print(capacity, math.floor(occupancy), len(achievedFalsePositives), np.mean(achievedFalsePositives),
-                  np.std(achievedFalsePositives))
+            print(capacity, occupancy, len(achievedFalsePositives[occupancy]), np.mean(achievedFalsePositives[occupancy]),
+                  np.std(achievedFalsePositives[occupancy]))
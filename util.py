@@ -1,5 +1,16 @@
 import pickle
 import random
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+from tqdm import tqdm
+
+from binary_trace import is_binary_trace, load_binary_trace, intern_packets
+
+# Width of one 5-tuple record in a trace
+RECORD_BYTES = 13
 
 
 def add_bool_arg(parser, name, default=False):
@@ -46,6 +57,92 @@ def load_trace(fname, sample, sample_rate):
     raise Exception("Trace not exists")
 
 
+def load_run_trace(fname, sample, sample_rate):
+    """
+    Load a trace in either format for the CAIDA runs, interned to dense flow ids and
+    indexed by first arrival (see index_first_arrivals). The format is detected from
+    the file's magic bytes, not its name: binary traces are memory-mapped, pickled
+    traces go through load_trace and are interned once here.
+    Returns (trace, n_flows, n_pkts) with trace = (flows, flow_ids, firstArrival).
+    """
+    if is_binary_trace(fname):
+        flows, flow_ids = load_binary_trace(fname, sample, sample_rate)
+    else:
+        flows, flow_ids = intern_packets(load_trace(fname, sample, sample_rate))
+    trace = index_first_arrivals(flows, flow_ids)
+    return trace, flows.shape[0], len(flow_ids)
+
+
+def index_first_arrivals(flows, flow_ids):
+    """
+    Number flows in first-arrival order and find the index of each flow's first packet.
+    Afterwards the first k flows to arrive are ids 0..k-1 and the packets before
+    firstArrival[k] only belong to flows 0..k-1, so S/A sets and the insert/query
+    streams of every ratio are plain slices.
+    Traces from intern_packets and binary_trace are already numbered in first-seen
+    order and are indexed in one linear pass; only other numberings are sorted.
+    Returns (flows, flow_ids, firstArrival).
+    """
+    firstArrival = first_seen_arrivals(flow_ids, flows.shape[0])
+    if firstArrival is not None:
+        return flows, flow_ids, firstArrival
+
+    _, firstArrival = np.unique(flow_ids, return_index=True)
+    order = np.argsort(firstArrival, kind="stable")
+    rank = np.empty(len(order), dtype=np.uint32)
+    rank[order] = np.arange(len(order), dtype=np.uint32)
+    flows = flows[order]
+    flow_ids = rank[flow_ids]
+    firstArrival = firstArrival[order]
+    return flows, flow_ids, firstArrival.astype(np.int64)
+
+
+def first_seen_arrivals(flow_ids, n_flows, chunk=1 << 20):
+    """
+    First packet of every flow when flow ids are numbered in first-seen order, i.e.
+    each new flow is the running maximum id + 1; the first packets are then the
+    positions where the id exceeds the running maximum. Reads the stream one chunk
+    at a time, so a memory-mapped trace needs O(chunk) extra memory.
+    Returns None when the ids are not in first-seen order.
+    """
+    firstArrival = np.empty(n_flows, dtype=np.int64)
+    seen = 0
+    for start in range(0, len(flow_ids), chunk):
+        ids = np.asarray(flow_ids[start:start + chunk], dtype=np.int64)
+        runMax = np.maximum.accumulate(ids)
+        previous = np.empty_like(runMax)
+        previous[0] = seen - 1
+        np.maximum(runMax[:-1], seen - 1, out=previous[1:])
+        new = np.flatnonzero(ids > previous)
+        if seen + len(new) > n_flows or np.any(
+                ids[new] != np.arange(seen, seen + len(new))):
+            return None
+        firstArrival[seen:seen + len(new)] = start + new
+        seen += len(new)
+    if seen != n_flows:
+        return None
+    return firstArrival
+
+
+def flow_key(flows, flowId):
+    """
+    Int key of one flow of the flow dictionary (see crc_hash.array_to_keys). Keys are
+    built on demand so no run holds a Python int for every flow of the trace.
+    """
+    return int.from_bytes(flows[flowId].tobytes(), "little")
+
+
+def iter_flow_ids(flow_ids, desc=None, chunk=1 << 16):
+    """
+    Iterate a flow id stream as Python ints, converting one chunk at a time
+    """
+    with tqdm(total=len(flow_ids), desc=desc) as progress:
+        for start in range(0, len(flow_ids), chunk):
+            ids = flow_ids[start:start + chunk].tolist()
+            progress.update(len(ids))
+            yield from ids
+
+
 def get_trace_stats(fiveTuple_list):
     """
     Get #flows, #pkts from the trace
@@ -56,3 +153,100 @@ def get_trace_stats(fiveTuple_list):
     n_flows = len(st)
     n_pkts = len(fiveTuple_list)
     return n_flows, n_pkts
+
+
+def trace_layout(n_flows, n_pkts):
+    """
+    Byte offsets of the flow ids and first arrivals, and total size of a trace in shared memory
+    """
+    idsOffset = (n_flows * RECORD_BYTES + 7) // 8 * 8
+    firstArrivalOffset = (idsOffset + n_pkts * 4 + 7) // 8 * 8
+    return idsOffset, firstArrivalOffset, firstArrivalOffset + n_flows * 8
+
+
+def publish_trace(trace):
+    """
+    Copy a trace (flows, flow_ids, firstArrival) into one shared memory block.
+    Returns the SharedMemory (the caller closes and unlinks it) and the spec
+    attach_trace needs to map it in another process.
+    """
+    flows, flow_ids, firstArrival = trace
+    n_flows, n_pkts = len(flows), len(flow_ids)
+    shm = shared_memory.SharedMemory(
+        create=True, size=max(trace_layout(n_flows, n_pkts)[2], 1))
+    for dst, src in zip(shared_trace_arrays(shm, n_flows, n_pkts), trace):
+        dst[:] = src
+    return shm, (shm.name, n_flows, n_pkts)
+
+
+def attach_trace(spec):
+    """
+    Map a trace published with publish_trace without copying it.
+    Returns the SharedMemory (keep it open while the trace is used) and the trace.
+    """
+    name, n_flows, n_pkts = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, shared_trace_arrays(shm, n_flows, n_pkts)
+
+
+def shared_trace_arrays(shm, n_flows, n_pkts):
+    """
+    (flows, flow_ids, firstArrival) views over a shared memory block
+    """
+    idsOffset, firstArrivalOffset, _ = trace_layout(n_flows, n_pkts)
+    flows = np.ndarray((n_flows, RECORD_BYTES), dtype=np.uint8, buffer=shm.buf)
+    flow_ids = np.ndarray((n_pkts,), dtype=np.uint32, buffer=shm.buf,
+                          offset=idsOffset)
+    firstArrival = np.ndarray((n_flows,), dtype=np.int64, buffer=shm.buf,
+                              offset=firstArrivalOffset)
+    return flows, flow_ids, firstArrival
+
+
+# Per-process state of a ratio sweep pool, set by init_cell_worker
+_cell_worker = dict()
+
+
+def init_cell_worker(target, traceSpec, n_flows):
+    """
+    Process pool initializer. Attaches to the shared trace so every worker reads
+    the same copy of it.
+    """
+    _cell_worker["target"] = target
+    _cell_worker["shm"], _cell_worker["trace"] = attach_trace(traceSpec)
+    _cell_worker["n_flows"] = n_flows
+
+
+def run_cell(task):
+    """
+    Run one (traceLabel, fingerprintLength, ratio, adapt) cell with a run_thread-style
+    target and return the value it stored for the ratio
+    """
+    tid, cell, kwargs = task
+    (traceLabel, fingerprintLength, ratio, adapt) = cell
+    ratio2FP = dict()
+    _cell_worker["target"](tid, _cell_worker["trace"], ratio, _cell_worker["n_flows"],
+                           adapt, fingerprintLength, ratio2FP, threading.Lock(), **kwargs)
+    return cell, ratio2FP[ratio]
+
+
+def run_cells_in_pool(target, cells, trace, n_flows, workers, cellKwargs=None):
+    """
+    Run every cell of a ratio sweep in a pool of worker processes.
+    target has the run_thread signature of CAIDA_run.py / CAIDA_run_fixed.py and
+    receives the interned trace mapped from shared memory, plus the keyword
+    arguments cellKwargs maps the cell to (pickled for each cell).
+    Returns a mapping from cell to result.
+    """
+    results = dict()
+    tasks = [(tid, cell, cellKwargs.get(cell, dict()) if cellKwargs else dict())
+             for tid, cell in enumerate(cells)]
+    shm, traceSpec = publish_trace(trace)
+    try:
+        with multiprocessing.Pool(workers, initializer=init_cell_worker,
+                                  initargs=(target, traceSpec, n_flows)) as pool:
+            for cell, result in pool.imap_unordered(run_cell, tasks):
+                results[cell] = result
+    finally:
+        shm.close()
+        shm.unlink()
+    return results